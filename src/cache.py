@@ -1,7 +1,10 @@
 import logging
 import itertools
-from datetime import datetime, timedelta
-from threading import RLock
+import json
+import sqlite3
+import time
+from datetime import datetime
+from threading import Lock, RLock
 
 from src.globals import *
 
@@ -13,8 +16,6 @@ class CachedMessage():
 		self.warned = False # was the user warned for this message?
 		self.upvoted = set() # set of users that have given this message karma
 		self.downvoted = set() # set of users that have taken this message karma
-	def isExpired(self):
-		return datetime.now() >= self.time + timedelta(hours=24)
 	def hasUpvoted(self, user):
 		return user.id in self.upvoted
 	def hasDownvoted(self, user):
@@ -30,24 +31,67 @@ class Cache():
 		self.counter = itertools.count()
 		self.msgs = {} # dict(msid -> CachedMessage)
 		self.idmap = {} # dict(uid -> dict(msid -> opaque))
-	def _saveMapping(self, x, uid, msid, data):
-		if uid not in x.keys():
-			x[uid] = {}
-		x[uid][msid] = data
-	def _lookupMapping(self, x, uid, msid, data):
-		if uid not in x.keys():
+		self.revmap = {} # dict(uid -> dict(opaque -> msid)), reverse of idmap
+		self.msgmap = {} # dict(msid -> dict(uid -> opaque)), who received a message
+		self.owned = {} # dict(uid -> set(msid)), messages sent by a user
+		self.buckets = {} # dict(bucket -> list(msid)), in ascending order
+	def _saveMapping(self, uid, msid, data):
+		if msid not in self.msgs.keys():
+			return # expired or deleted in the meantime
+		if uid not in self.idmap.keys():
+			self.idmap[uid] = {}
+			self.revmap[uid] = {}
+		old = self.idmap[uid].get(msid, None)
+		if old is not None:
+			self._deleteReverse(uid, old, msid)
+		self.idmap[uid][msid] = data
+		self.revmap[uid][data] = msid
+		if msid not in self.msgmap.keys():
+			self.msgmap[msid] = {}
+		self.msgmap[msid][uid] = data
+	def _deleteReverse(self, uid, data, msid):
+		rev = self.revmap[uid]
+		if rev.get(data, None) == msid:
+			del rev[data]
+	@staticmethod
+	def _bucket(t):
+		return int(t) // (CACHE_BUCKET_MINUTES * 60)
+	def _deleteOwned(self, uid, msid):
+		s = self.owned[uid]
+		s.discard(msid)
+		if len(s) == 0:
+			del self.owned[uid]
+	def _lookupMapping(self, uid, msid, data):
+		if uid not in self.idmap.keys():
 			return None
 		if msid is not None:
-			return x[uid].get(msid, None)
+			return self.idmap[uid].get(msid, None)
 		# data is not None
-		gen = ( msid for msid, _data in x[uid].items() if _data == data )
-		return next(gen, None)
+		return self.revmap[uid].get(data, None)
 
+	def _addMessage(self, msid, cm):
+		self.msgs[msid] = cm
+		b = Cache._bucket(cm.time.timestamp())
+		if b not in self.buckets.keys():
+			self.buckets[b] = []
+		self.buckets[b].append(msid)
+		if cm.user_id is not None:
+			if cm.user_id not in self.owned.keys():
+				self.owned[cm.user_id] = set()
+			self.owned[cm.user_id].add(msid)
+
+	def register_tasks(self, sched):
+		return
+	def close(self):
+		return
 	def assignMessageId(self, cm: CachedMessage) -> int:
 		with self.lock:
 			ret = next(self.counter)
-			self.msgs[ret] = cm
+			self._addMessage(ret, cm)
 		return ret
+	# to be called after a CachedMessage was changed (warned, votes)
+	def updateMessage(self, msid):
+		return
 	def getMessage(self, msid):
 		with self.lock:
 			return self.msgs.get(msid, None)
@@ -57,29 +101,157 @@ class Cache():
 				functor(msid, cm)
 	def getMessages(self, uid):
 		with self.lock:
-			return {msid: msg for msid, msg in self.msgs.items() if msg.user_id == uid}
+			return {msid: self.msgs[msid] for msid in self.owned.get(uid, ())}
 	def saveMapping(self, uid, msid, data):
 		with self.lock:
-			self._saveMapping(self.idmap, uid, msid, data)
+			self._saveMapping(uid, msid, data)
 	def lookupMapping(self, uid, msid=None, data=None):
 		if msid is None and data is None:
 			raise ValueError()
 		with self.lock:
-			return self._lookupMapping(self.idmap, uid, msid, data)
+			return self._lookupMapping(uid, msid, data)
+	# returns dict(uid -> opaque) of everyone who has a mapping for `msid`
+	def getMappings(self, msid):
+		with self.lock:
+			return dict(self.msgmap.get(msid, {}))
 	def deleteMappings(self, msid):
 		with self.lock:
-			for d in self.idmap.values():
-				d.pop(msid, None)
+			for uid, data in self.msgmap.pop(msid, {}).items():
+				d = self.idmap[uid]
+				del d[msid]
+				self._deleteReverse(uid, data, msid)
+				if len(d) == 0:
+					del self.idmap[uid]
+					del self.revmap[uid]
+	# drops all buckets that only contain expired messages, the lock is only
+	# held for one bucket at a time
+	# This relies on self.buckets being ordered by ascending bucket, which
+	# holds because both _load() and assignMessageId() add messages in the
+	# order they were sent.
 	def expire(self):
 		ids = set()
-		with self.lock:
-			for msid in list(self.msgs.keys()):
-				if not self.msgs[msid].isExpired():
-					continue
-				ids.add(msid)
-				# delete message itself and from mappings
-				del self.msgs[msid]
-				self.deleteMappings(msid)
+		cutoff = Cache._bucket(time.time() - CACHE_EXPIRE_HOURS * 3600)
+		while True:
+			with self.lock:
+				b = next(iter(self.buckets.keys()), None)
+				if b is None or b >= cutoff:
+					break
+				msids = self.buckets.pop(b)
+				for msid in msids:
+					# delete message itself and from mappings
+					cm = self.msgs.pop(msid)
+					if cm.user_id is not None:
+						self._deleteOwned(cm.user_id, msid)
+					self.deleteMappings(msid)
+			ids.update(msids)
 		if len(ids) > 0:
 			logging.debug("Expired %d entries from cache", len(ids))
 		return ids
+
+# Cache that additionally records everything into an SQLite file, so that
+# messages from before a restart can still be replied to, voted on or moderated.
+# Writes are buffered and done every few seconds.
+
+class PersistentCache(Cache):
+	def __init__(self, path):
+		super(PersistentCache, self).__init__()
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		self.db_lock = Lock()
+		self.pending = [] # list((sql, params)) in the order they happened
+		self.db.execute("PRAGMA journal_mode=WAL")
+		self.db.execute("PRAGMA synchronous=NORMAL")
+		self.db.execute("""
+CREATE TABLE IF NOT EXISTS `messages` (
+	`msid` INTEGER NOT NULL,
+	`user_id` BIGINT,
+	`time` REAL NOT NULL,
+	`warned` TINYINT NOT NULL,
+	`upvoted` TEXT NOT NULL,
+	`downvoted` TEXT NOT NULL,
+	PRIMARY KEY (`msid`)
+);
+		""".strip())
+		self.db.execute("""
+CREATE TABLE IF NOT EXISTS `mappings` (
+	`msid` INTEGER NOT NULL,
+	`uid` BIGINT NOT NULL,
+	`data` BIGINT NOT NULL,
+	PRIMARY KEY (`msid`, `uid`)
+) WITHOUT ROWID;
+		""".strip())
+		self.db.execute("CREATE INDEX IF NOT EXISTS `messages_time` ON `messages`(`time`)")
+		self._load()
+	def _load(self):
+		cutoff = time.time() - CACHE_EXPIRE_HOURS * 3600
+		with self.db_lock:
+			# msids increase with time, so everything older can be dropped by msid
+			row = self.db.execute("SELECT `msid` FROM messages WHERE `time` >= ? ORDER BY `time` LIMIT 1", (cutoff, )).fetchone()
+			first = None if row is None else row[0]
+			if first is None:
+				row = self.db.execute("SELECT MAX(`msid`) FROM messages").fetchone()
+				first = 0 if row[0] is None else row[0] + 1
+			self.db.execute("DELETE FROM messages WHERE `msid` < ?", (first, ))
+			self.db.execute("DELETE FROM mappings WHERE `msid` < ?", (first, ))
+			self.db.commit()
+			msgs = self.db.execute("SELECT * FROM messages ORDER BY `msid`").fetchall()
+			mappings = self.db.execute("SELECT `msid`, `uid`, `data` FROM mappings").fetchall()
+		with self.lock:
+			for msid, user_id, t, warned, upvoted, downvoted in msgs:
+				cm = CachedMessage(user_id)
+				cm.time = datetime.fromtimestamp(t)
+				cm.warned = bool(warned)
+				cm.upvoted = set(json.loads(upvoted))
+				cm.downvoted = set(json.loads(downvoted))
+				self._addMessage(msid, cm)
+			for msid, uid, data in mappings:
+				self._saveMapping(uid, msid, data)
+			self.counter = itertools.count(msgs[-1][0] + 1 if len(msgs) > 0 else first)
+		logging.info("Loaded %d messages and %d mappings into cache", len(msgs), len(mappings))
+	def _recordMessage(self, msid, cm):
+		sql = "REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)"
+		param = (msid, cm.user_id, cm.time.timestamp(), cm.warned,
+			json.dumps(list(cm.upvoted)), json.dumps(list(cm.downvoted)))
+		self.pending.append((sql, param))
+	def register_tasks(self, sched):
+		sched.register(self.flush, seconds=CACHE_FLUSH_SECONDS)
+	def close(self):
+		self.flush()
+		with self.db_lock:
+			self.db.close()
+	def flush(self):
+		with self.db_lock:
+			with self.lock:
+				l, self.pending = self.pending, []
+			if len(l) == 0:
+				return
+			for sql, group in itertools.groupby(l, key=lambda x: x[0]):
+				self.db.executemany(sql, (param for _, param in group))
+			self.db.commit()
+	def assignMessageId(self, cm):
+		with self.lock:
+			ret = super(PersistentCache, self).assignMessageId(cm)
+			self._recordMessage(ret, cm)
+		return ret
+	def updateMessage(self, msid):
+		with self.lock:
+			cm = self.msgs.get(msid, None)
+			if cm is not None:
+				self._recordMessage(msid, cm)
+	def saveMapping(self, uid, msid, data):
+		with self.lock:
+			if msid not in self.msgs.keys():
+				return
+			self._saveMapping(uid, msid, data)
+			sql = "REPLACE INTO mappings VALUES (?, ?, ?)"
+			self.pending.append((sql, (msid, uid, data)))
+	def deleteMappings(self, msid):
+		with self.lock:
+			super(PersistentCache, self).deleteMappings(msid)
+			self.pending.append(("DELETE FROM mappings WHERE `msid` = ?", (msid, )))
+	def expire(self):
+		ids = super(PersistentCache, self).expire()
+		if len(ids) > 0:
+			with self.lock:
+				sql = "DELETE FROM messages WHERE `msid` = ?"
+				self.pending.extend((sql, (msid, )) for msid in ids)
+		return ids
@@ -1,11 +1,16 @@
 import logging
+import os
 import sys
+import json
+import heapq
+import time
+from collections import Counter, OrderedDict
 from datetime import datetime, timedelta
 from threading import Lock
 
 import src.replies as rp
 from src.globals import *
-from src.database import User, SystemConfig
+from src.database import User, SystemConfig, getMessagePriority, getObfuscatedIdSalt, getObfuscatedIdValue, parseObfuscatedId
 from src.cache import CachedMessage
 from src.util import genTripcode, getLastModFile
 
@@ -14,9 +19,13 @@ launched = None
 db = None
 ch = None
 spam_scores = None
-sign_last_used = {} # uid -> datetime
-vote_up_last_used = {} # uid -> datetime
-vote_down_last_used = {} # uid -> datetime
+recipients = None
+stats = None
+oids = None
+last_file_mod = None
+votes_lock = Lock() # checking and recording a vote has to be atomic
+rate_limits = None # name -> CooldownStore
+rate_limit_file = None
 
 reg_open = None
 log_channel = None
@@ -34,13 +43,16 @@ vote_up_interval = None
 vote_down_interval = None
 
 def init(config, _db, _ch):
-	global launched, db, ch, spam_scores, reg_open, log_channel, karma_amount_add, karma_amount_remove, karma_level_names, blacklist_contact, bot_name, karma_is_pats, enable_signing, allow_remove_command, media_limit_period, sign_interval, vote_up_interval, vote_down_interval
+	global launched, db, ch, spam_scores, recipients, stats, oids, reg_open, log_channel, karma_amount_add, karma_amount_remove, karma_level_names, blacklist_contact, bot_name, karma_is_pats, enable_signing, allow_remove_command, media_limit_period, sign_interval, vote_up_interval, vote_down_interval, rate_limits, rate_limit_file
 
 	launched = datetime.now()
 
 	db = _db
 	ch = _ch
 	spam_scores = ScoreKeeper()
+	recipients = RecipientIndex()
+	stats = LoungeStats()
+	oids = ObfuscatedIdIndex()
 
 	reg_open = config.get("reg_open", "")
 	log_channel = config.get("log_channel", False)
@@ -59,6 +71,14 @@ def init(config, _db, _ch):
 	sign_interval = timedelta(seconds=int(config.get("sign_limit_interval", 600)))
 	vote_up_interval = timedelta(seconds=int(config.get("vote_up_limit_interval", 0)))
 	vote_down_interval = timedelta(seconds=int(config.get("vote_down_limit_interval", 60)))
+	rate_limits = {
+		"sign": CooldownStore(sign_interval),
+		"vote_up": CooldownStore(vote_up_interval),
+		"vote_down": CooldownStore(vote_down_interval),
+	}
+	rate_limit_file = config.get("ratelimit_file")
+	if rate_limit_file:
+		load_rate_limits()
 
 	if config.get("locale"):
 		rp.localization = __import__("src.replies_" + config["locale"],
@@ -70,18 +90,43 @@ def init(config, _db, _ch):
 		c.defaults()
 		db.setSystemConfig(c)
 
+	users = list(db.iterateUsers(fields=INDEX_FIELDS))
+	recipients.rebuild(users)
+	stats.rebuild(users, db.countUsers())
+	logging.info("%d users in chat", len(recipients))
+	db.on_external_write = resync_users
+
+# brings the in-memory indexes up to date after e.g. util/blacklist.py banned
+# someone behind our back
+def resync_users():
+	n = 0
+	for user in db.iterateUsers(fields=INDEX_FIELDS):
+		stats.update(user)
+		r = recipients.get(user.id)
+		if user.isJoined() == (r is not None) and (r is None or r.rank == user.rank):
+			continue
+		recipients.update(user)
+		n += 1
+	if n > 0:
+		logging.info("%d users were changed by another process", n)
+
+def close():
+	if rate_limit_file:
+		save_rate_limits()
+
 def register_tasks(sched):
-	# spam score handling
-	sched.register(spam_scores.scheduledTask, seconds=SPAM_INTERVAL_SECONDS)
+	# saving cooldowns (also done on close)
+	if rate_limit_file:
+		sched.register(save_rate_limits, minutes=RATE_LIMIT_SAVE_MINUTES)
 	# warning removal
 	def task():
 		now = datetime.now()
-		for user in db.iterateUsers():
-			if not user.isJoined():
-				continue
-			if user.warnExpiry is not None and now >= user.warnExpiry:
-				with db.modifyUser(id=user.id) as user:
-					user.removeWarning()
+		# this can run more than once, so check again every time
+		def f(user):
+			if user.warnExpiry is not None and user.warnExpiry <= now:
+				user.removeWarning()
+		for user in db.iterateExpiredWarnings(now):
+			db.updateUser(user.id, f)
 	sched.register(task, minutes=15)
 
 def updateUserFromEvent(user, c_user):
@@ -90,31 +135,30 @@ def updateUserFromEvent(user, c_user):
 	user.lastActive = datetime.now()
 
 def getUserByName(username):
-	username = username.lower()
-	# there *should* only be a single joined user with a given username
-	for user in db.iterateUsers():
-		if not user.isJoined():
-			continue
-		if user.username is not None and user.username.lower() == username:
-			return user
-	return None
+	try:
+		return db.findUserByName(username)
+	except KeyError as e:
+		return None
 
-def getUserByOid(oid):
-	for user in db.iterateUsers():
-		if not user.isJoined():
-			continue
-		if user.getObfuscatedId() == oid:
-			return user
-	return None
+# there can be more than one user with an obfuscated id
+def getUsersByOid(oid):
+	return list(db.getUser(id=uid) for uid in oids.lookup(oid))
 
 def getRecentlyActiveUsers():
-	users = db.iterateUsers()
 	cache_start_datetime = max(launched, datetime.now() - timedelta(hours=24))
-	count = 0
-	for user in users:
-		if (user.lastActive is not None) and (user.lastActive > cache_start_datetime):
-			count += 1
-	return count
+	return stats.countActive(cache_start_datetime)
+
+# the files don't change while we're running, so this only needs to be done once
+def getLastFileMod():
+	global last_file_mod
+	if last_file_mod is None:
+		last_file_mod = max(
+			getLastModFile(),
+			getLastModFile("src"),
+			getLastModFile("util"),
+			key=lambda file: file["last_mod"]
+		)["last_mod"]
+	return last_file_mod
 
 def getKarmaLevel(karma):
 	karma_level = 0
@@ -140,8 +184,10 @@ def requireUser(func):
 				return rp.Reply(rp.types.USER_NOT_IN_CHAT, bot_name=bot_name)
 
 		# keep db entry up to date
-		with db.modifyUser(id=user.id) as user:
-			updateUserFromEvent(user, c_user)
+		updateUserFromEvent(user, c_user)
+		db.touchUser(user)
+		recipients.touch(user)
+		stats.touch(user)
 
 		# check for blacklist or absence
 		if user.isBlacklisted():
@@ -168,28 +214,265 @@ def requireRank(need_rank):
 
 # RAM cache for spam scores
 
+# Spam scores go down by one every SPAM_INTERVAL_SECONDS. Instead of doing
+# that periodically the decay is computed whenever a score is looked at.
+# Scores are split by uid over several locks, each part ordered by when its
+# scores were last updated so that stale ones can be dropped from the front.
+
 class ScoreKeeper():
 	def __init__(self):
-		self.lock = Lock()
-		self.scores = {}
+		self.locks = list(Lock() for i in range(SPAM_STRIPES))
+		self.scores = list(OrderedDict() for i in range(SPAM_STRIPES)) # uid -> (score, time)
+	@staticmethod
+	def _decayed(entry, now):
+		score, t = entry
+		return score - (now - t) / SPAM_INTERVAL_SECONDS
 	def increaseSpamScore(self, uid, n):
-		with self.lock:
-			s = self.scores.get(uid, 0)
+		i = uid % SPAM_STRIPES
+		now = time.monotonic()
+		with self.locks[i]:
+			scores = self.scores[i]
+			self._evict(scores, now)
+			entry = scores.get(uid)
+			s = 0 if entry is None else max(0, self._decayed(entry, now))
+			ok = True
 			if s > SPAM_LIMIT:
 				return False
 			elif s + n > SPAM_LIMIT:
-				self.scores[uid] = SPAM_LIMIT_HIT
-				return s + n <= SPAM_LIMIT_HIT
-			self.scores[uid] = s + n
+				ok = s + n <= SPAM_LIMIT_HIT
+				s = SPAM_LIMIT_HIT
+			else:
+				s += n
+			scores[uid] = (s, now)
+			scores.move_to_end(uid)
+			return ok
+	# drops a few of the least recently updated scores if they've reached zero
+	def _evict(self, scores, now):
+		for i in range(SPAM_EVICT_BATCH):
+			if len(scores) == 0:
+				break
+			uid, entry = next(iter(scores.items()))
+			if self._decayed(entry, now) > 0:
+				break
+			del scores[uid]
+
+# Remembers who did something that may only be done once per interval and
+# when. Entries are dropped once the interval has passed, since it's the same
+# for all of them the oldest entry is always the first one.
+
+class CooldownStore():
+	def __init__(self, interval):
+		self.interval = interval.total_seconds()
+		self.lock = Lock()
+		self.last_used = OrderedDict() # uid -> epoch
+	def _expire(self, now):
+		while len(self.last_used) > 0:
+			uid, t = next(iter(self.last_used.items()))
+			if now - t < self.interval:
+				break
+			del self.last_used[uid]
+	# whether the user may do it now, if so that is recorded
+	def use(self, uid):
+		if self.interval <= 1:
+			return True # disabled
+		now = time.time()
+		with self.lock:
+			self._expire(now)
+			if uid in self.last_used:
+				return False
+			self.last_used[uid] = now
 			return True
-	def scheduledTask(self):
+	def dump(self):
 		with self.lock:
-			for uid in list(self.scores.keys()):
-				s = self.scores[uid] - 1
-				if s <= 0:
-					del self.scores[uid]
-				else:
-					self.scores[uid] = s
+			self._expire(time.time())
+			return list(self.last_used.items())
+	def load(self, l):
+		with self.lock:
+			for uid, t in sorted(l, key=lambda e: e[1]):
+				self.last_used[uid] = t
+			self._expire(time.time())
+
+def load_rate_limits():
+	try:
+		with open(rate_limit_file, "r") as f:
+			d = json.load(f)
+	except FileNotFoundError as e:
+		return
+	for name, l in d.items():
+		if name in rate_limits.keys():
+			rate_limits[name].load(l)
+
+def save_rate_limits():
+	d = {name: limiter.dump() for name, limiter in rate_limits.items()}
+	with open(rate_limit_file + "~", "w") as f:
+		json.dump(d, f)
+	os.replace(rate_limit_file + "~", rate_limit_file)
+
+# what the indexes below need to know about users
+INDEX_FIELDS = ("rank", "left", "lastActive", "cooldownUntil", "debugEnabled")
+
+# RAM index of users in the chat, so messages can be relayed without reading
+# every user from the db. Must be updated whenever a user joins or leaves or
+# their rank or debug mode changes.
+
+class Recipient():
+	__slots__ = ("id", "rank", "lastActive", "debugEnabled")
+	def __init__(self, user):
+		self.id = user.id
+		self.rank = user.rank
+		self.lastActive = user.lastActive
+		self.debugEnabled = user.debugEnabled
+	def getMessagePriority(self):
+		return getMessagePriority(self.rank, self.lastActive)
+
+class RecipientIndex():
+	def __init__(self):
+		self.lock = Lock()
+		self.users = {} # uid -> Recipient
+	def __len__(self):
+		return len(self.users)
+	def rebuild(self, users):
+		d = {user.id: Recipient(user) for user in users if user.isJoined()}
+		with self.lock:
+			self.users = d
+	def update(self, user):
+		with self.lock:
+			if user.isJoined():
+				self.users[user.id] = Recipient(user)
+			else:
+				self.users.pop(user.id, None)
+	def touch(self, user):
+		with self.lock:
+			r = self.users.get(user.id)
+			if r is not None:
+				r.lastActive = user.lastActive
+	def get(self, uid):
+		with self.lock:
+			return self.users.get(uid)
+	def list(self):
+		with self.lock:
+			return list(self.users.values())
+
+# Maps obfuscated ids of joined users to their user ids, rebuilt when the
+# ids change every day.
+
+class ObfuscatedIdIndex():
+	def __init__(self):
+		self.lock = Lock()
+		self.salt = None
+		self.ids = {} # value -> list(uid)
+	def _check(self):
+		salt = getObfuscatedIdSalt()
+		if salt == self.salt:
+			return
+		ids = {}
+		for r in recipients.list():
+			ids.setdefault(getObfuscatedIdValue(r.id, salt), []).append(r.id)
+		collisions = sum(1 for l in ids.values() if len(l) > 1)
+		if collisions > 0:
+			logging.warning("%d obfuscated ids are shared by multiple users today", collisions)
+		self.salt, self.ids = salt, ids
+	def add(self, uid):
+		with self.lock:
+			self._check()
+			l = self.ids.setdefault(getObfuscatedIdValue(uid, self.salt), [])
+			if uid not in l:
+				l.append(uid)
+			if len(l) > 1:
+				logging.warning("Obfuscated id of %d is shared by %d users", uid, len(l))
+	def lookup(self, oid):
+		value = parseObfuscatedId(oid)
+		if value is None:
+			return []
+		with self.lock:
+			self._check()
+			l = self.ids.get(value, [])
+		# users that left in the meantime are still in here
+		return list(uid for uid in l if recipients.get(uid) is not None)
+
+# Counters for /users and /botinfo, kept up to date by the same state changes
+# as the recipient index (plus cooldowns and activity).
+
+class LoungeStats():
+	def __init__(self):
+		self.lock = Lock()
+		self.states = {} # uid -> "active", "inactive" or "blacklisted"
+		self.counts = Counter()
+		self.cooldowns = {} # uid -> datetime, only users currently in cooldown
+		self.cooldown_heap = [] # (datetime, uid) to expire entries of the above
+		self.last_minute = {} # uid -> minute the user was last active in
+		self.minutes = Counter() # minute -> number of users last active in it
+		self.recent = 0 # sum of self.minutes
+	@staticmethod
+	def _state(user):
+		if user.isBlacklisted():
+			return "blacklisted"
+		return "active" if user.isJoined() else "inactive"
+	@staticmethod
+	def _minute(t):
+		return int(t.timestamp() // 60)
+	# `counts` as returned by Database.countUsers()
+	def rebuild(self, users, counts):
+		with self.lock:
+			self.states = {user.id: LoungeStats._state(user) for user in users}
+			self.counts = Counter({k: counts[k] for k in ("active", "inactive", "blacklisted")})
+			self.cooldowns.clear()
+			self.cooldown_heap.clear()
+			for user in users:
+				if user.isInCooldown():
+					self.cooldowns[user.id] = user.cooldownUntil
+					self.cooldown_heap.append((user.cooldownUntil, user.id))
+			heapq.heapify(self.cooldown_heap)
+		# activity before startup is not counted, so that starts out empty
+	def update(self, user):
+		state = LoungeStats._state(user)
+		with self.lock:
+			old = self.states.get(user.id)
+			if old != state:
+				if old is not None:
+					self.counts[old] -= 1
+				self.counts[state] += 1
+				self.states[user.id] = state
+			if user.isInCooldown():
+				if self.cooldowns.get(user.id) != user.cooldownUntil:
+					self.cooldowns[user.id] = user.cooldownUntil
+					heapq.heappush(self.cooldown_heap, (user.cooldownUntil, user.id))
+			else:
+				self.cooldowns.pop(user.id, None)
+	def touch(self, user):
+		minute = LoungeStats._minute(user.lastActive)
+		with self.lock:
+			old = self.last_minute.get(user.id)
+			if old == minute:
+				return
+			if old is not None and old in self.minutes:
+				self.minutes[old] -= 1
+				self.recent -= 1
+			self.last_minute[user.id] = minute
+			self.minutes[minute] += 1
+			self.recent += 1
+	# number of users active since `t` (minute precision, must not decrease)
+	def countActive(self, t):
+		cutoff = LoungeStats._minute(t)
+		with self.lock:
+			# minutes are inserted in ascending order, so only look at the front
+			while len(self.minutes) > 0:
+				minute = next(iter(self.minutes))
+				if minute >= cutoff:
+					break
+				self.recent -= self.minutes.pop(minute)
+			return self.recent
+	def getCounts(self):
+		now = datetime.now()
+		with self.lock:
+			heap = self.cooldown_heap
+			while len(heap) > 0 and heap[0][0] < now:
+				until, uid = heapq.heappop(heap)
+				if self.cooldowns.get(uid) == until:
+					del self.cooldowns[uid]
+			d = {k: self.counts[k] for k in ("active", "inactive", "blacklisted")}
+			d["cooldown"] = len(self.cooldowns)
+		return d
 
 ###
 
@@ -245,13 +528,20 @@ def user_join(c_user):
 		elif user.isJoined():
 			err = rp.Reply(rp.types.USER_IN_CHAT, bot_name=bot_name)
 		if err is not None:
-			with db.modifyUser(id=user.id) as user:
-				updateUserFromEvent(user, c_user)
+			updateUserFromEvent(user, c_user)
+			db.touchUser(user)
+			recipients.touch(user)
+			stats.touch(user)
 			return err
 		# user rejoins
-		with db.modifyUser(id=user.id) as user:
+		def f(user):
 			updateUserFromEvent(user, c_user)
 			user.setLeft(False)
+		user = db.updateUser(user.id, f)
+		recipients.update(user)
+		oids.add(user.id)
+		stats.update(user)
+		stats.touch(user)
 		logging.info("%s rejoined chat", user)
 		return rp.Reply(rp.types.CHAT_JOIN, bot_name=bot_name)
 
@@ -270,6 +560,10 @@ def user_join(c_user):
 
 	logging.info("%s joined chat", user)
 	db.addUser(user)
+	recipients.update(user)
+	oids.add(user.id)
+	stats.update(user)
+	stats.touch(user)
 	ret.insert(0, rp.Reply(rp.types.CHAT_JOIN, bot_name=bot_name))
 
 	motd = db.getSystemConfig().motd
@@ -279,8 +573,9 @@ def user_join(c_user):
 	return ret
 
 def force_user_leave(user_id, blocked=True):
-	with db.modifyUser(id=user_id) as user:
-		user.setLeft()
+	user = db.updateUser(user_id, lambda user: user.setLeft())
+	recipients.update(user)
+	stats.update(user)
 	if blocked:
 		logging.warning("Force leaving %s because bot is blocked", user)
 	Sender.stop_invoked(user)
@@ -346,36 +641,27 @@ def get_karma_info(user):
 
 @requireUser
 @requireRank(RANKS.admin)
-def get_bot_info(user):
+def get_bot_info(user, delivery):
 	params = {
 		"python_ver": sys.version,
 		"os": sys.platform,
-		"last_file_mod":
-			max(
-				getLastModFile(),
-				getLastModFile("src"),
-				getLastModFile("util"),
-				key=lambda file: file["last_mod"]
-			)["last_mod"],
+		"last_file_mod": getLastFileMod(),
 		"launched": launched,
 		"time": format_datetime(datetime.now(), True),
 		"cached_msgs": len(ch.msgs),
-		"active_users": getRecentlyActiveUsers()
+		"active_users": getRecentlyActiveUsers(),
+		"user_cache_rate": db.getCacheStats()["rate"],
+		"db_conflicts": db.getUpdateStats()["conflicts"],
+		"queued_msgs": delivery["queued"],
+		"send_threads": delivery["workers"],
+		"send_rate": delivery["rate"],
 	}
 	return rp.Reply(rp.types.BOT_INFO, **params)
 
 @requireUser
 def get_users(user):
-	active, inactive, black, cooldown = 0, 0, 0, 0
-	for user2 in db.iterateUsers():
-		if user2.isBlacklisted():
-			black += 1
-		elif not user2.isJoined():
-			inactive += 1
-		else:
-			active += 1
-		if user2.isInCooldown():
-			cooldown += 1
+	d = stats.getCounts()
+	active, inactive, black, cooldown = d["active"], d["inactive"], d["blacklisted"], d["cooldown"]
 	if user.rank < RANKS.mod:
 		return rp.Reply(rp.types.USERS_INFO,
         	active=active, inactive=inactive + black, total=active + inactive + black)
@@ -410,17 +696,18 @@ def set_rules(user, arg):
 
 @requireUser
 def toggle_debug(user):
-	with db.modifyUser(id=user.id) as user:
+	def f(user):
 		user.debugEnabled = not user.debugEnabled
-		new = user.debugEnabled
-	return rp.Reply(rp.types.BOOLEAN_CONFIG, description="Debug mode", enabled=new)
+	user = db.updateUser(user.id, f)
+	recipients.update(user)
+	return rp.Reply(rp.types.BOOLEAN_CONFIG, description="Debug mode", enabled=user.debugEnabled)
 
 @requireUser
 def toggle_karma(user):
-	with db.modifyUser(id=user.id) as user:
+	def f(user):
 		user.hideKarma = not user.hideKarma
-		new = user.hideKarma
-	return rp.Reply(rp.types.BOOLEAN_CONFIG, description=("Pat" if karma_is_pats else "Karma") + " notifications", enabled=not new)
+	user = db.updateUser(user.id, f)
+	return rp.Reply(rp.types.BOOLEAN_CONFIG, description=("Pat" if karma_is_pats else "Karma") + " notifications", enabled=not user.hideKarma)
 
 @requireUser
 def get_tripcode(user):
@@ -439,8 +726,9 @@ def set_tripcode(user, text):
 	if "\n" in text or len(text) > 30:
 		return rp.Reply(rp.types.ERR_INVALID_TRIP_FORMAT)
 
-	with db.modifyUser(id=user.id) as user:
+	def f(user):
 		user.tripcode = text
+	user = db.updateUser(user.id, f)
 	tripname, tripcode = genTripcode(user.tripcode)
 	return rp.Reply(rp.types.TRIPCODE_SET, tripname=tripname, tripcode=tripcode)
 
@@ -453,8 +741,11 @@ def promote_user(user, username2, rank):
 
 	if user2.rank >= rank:
 		return
-	with db.modifyUser(id=user2.id) as user2:
+	def f(user2):
 		user2.rank = rank
+	user2 = db.updateUser(user2.id, f)
+	recipients.update(user2)
+	stats.update(user2)
 	if rank >= RANKS.admin:
 		_push_system_message(rp.Reply(rp.types.PROMOTED_ADMIN), who=user2)
 	elif rank >= RANKS.mod:
@@ -485,51 +776,56 @@ def warn_user(user, msid, delete=False, del_all=False, duration=""):
 	if cm is None or cm.user_id is None:
 		return rp.Reply(rp.types.ERR_NOT_IN_CACHE)
 
+	cooldown = None
+	if duration != "":
+		cooldown = {
+			"seconds": 0,
+			"minutes": 0,
+			"hours": 0,
+			"days": 0,
+			"weeks": 0
+		}
+		cooldown_keys = {
+			"s": "seconds",
+			"m": "minutes",
+			"h": "hours",
+			"d": "days",
+			"w": "weeks",
+			"sec": "seconds",
+			"min": "minutes"
+		}
+		i = 0
+		while i < len(duration):
+			n = ""
+			while (i < len(duration)) and (duration[i] == " "):
+				i += 1
+			while (i < len(duration)) and (duration[i] >= "0") and (duration[i] <= "9"):
+				n += duration[i]
+				i += 1
+			while (i < len(duration)) and (duration[i] == " "):
+				i += 1
+			if not (duration[i].lower() in cooldown_keys):
+				return rp.Reply(rp.types.ERR_INVALID_DURATION)
+			key = cooldown_keys[duration[i]]
+			if (cooldown[key] != 0) or not n.isnumeric():
+				return rp.Reply(rp.types.ERR_INVALID_DURATION)
+			cooldown[key] = int(n)
+			i += 1
+		cooldown = timedelta(**cooldown)
+
 	d = None
 	if not cm.warned:
-		with db.modifyUser(id=cm.user_id) as user2:
-			if duration == "":
-				d = user2.addWarning()
-			else:
-				cooldown = {
-					"seconds": 0,
-					"minutes": 0,
-					"hours": 0,
-					"days": 0,
-					"weeks": 0
-				}
-				cooldown_keys = {
-					"s": "seconds",
-					"m": "minutes",
-					"h": "hours",
-					"d": "days",
-					"w": "weeks",
-					"sec": "seconds",
-					"min": "minutes"
-				}
-				i = 0
-				while i < len(duration):
-					n = ""
-					while (i < len(duration)) and (duration[i] == " "):
-						i += 1
-					while (i < len(duration)) and (duration[i] >= "0") and (duration[i] <= "9"):
-						n += duration[i]
-						i += 1
-					while (i < len(duration)) and (duration[i] == " "):
-						i += 1
-					if not (duration[i].lower() in cooldown_keys):
-						return rp.Reply(rp.types.ERR_INVALID_DURATION)
-					key = cooldown_keys[duration[i]]
-					if (cooldown[key] != 0) or not n.isnumeric():
-						return rp.Reply(rp.types.ERR_INVALID_DURATION)
-					cooldown[key] = int(n)
-					i += 1
-				d = user2.addWarning(timedelta(**cooldown))
+		def f(user2):
+			nonlocal d
+			d = user2.addWarning(cooldown)
 			user2.karma -= KARMA_WARN_PENALTY
+		user2 = db.updateUser(cm.user_id, f)
+		stats.update(user2)
 		_push_system_message(
 			rp.Reply(rp.types.GIVEN_COOLDOWN, duration=d, deleted=delete),
 			who=user2, reply_to=msid)
 		cm.warned = True
+		ch.updateMessage(msid)
 	else:
 		user2 = db.getUser(id=cm.user_id)
 		if not delete: # allow deleting already warned messages
@@ -537,8 +833,7 @@ def warn_user(user, msid, delete=False, del_all=False, duration=""):
 	if delete:
 		if del_all:
 			msgs = ch.getMessages(cm.user_id)
-			for cm2 in msgs:
-				Sender.delete([cm2])
+			Sender.delete(list(msgs))
 			if d is not None:
 				logging.info("%s warned %s (cooldown: %s) and deleted all %d messages", user, user2.getObfuscatedId(), d, len(msgs))
 			else:
@@ -572,8 +867,7 @@ def delete_message(user, msid, del_all=False):
 
 	if del_all:
 		msgs = ch.getMessages(user2.id)
-		for cm2 in msgs:
-			Sender.delete([cm2])
+		Sender.delete(list(msgs))
 		logging.info("%s deleted all messages from %s", user, user2.getObfuscatedId())
 		return rp.Reply(rp.types.SUCCESS_DELETEALL, id=user2.getObfuscatedId(), count=len(msgs))
 	else:
@@ -596,6 +890,8 @@ def cleanup_messages(user):
 			msids.append(msid)
 			cm.upvoted.add(1337)
 	ch.iterateMessages(f)
+	for msid in msids:
+		ch.updateMessage(msid)
 	logging.info("%s invoked cleanup (matched: %d)", user, len(msids))
 	Sender.delete(msids)
 	return rp.Reply(rp.types.DELETION_QUEUED, count=len(msids))
@@ -604,9 +900,12 @@ def cleanup_messages(user):
 @requireRank(RANKS.admin)
 def uncooldown_user(user, oid2=None, username2=None):
 	if oid2 is not None:
-		user2 = getUserByOid(oid2)
-		if user2 is None:
+		users2 = getUsersByOid(oid2)
+		if len(users2) == 0:
 			return rp.Reply(rp.types.ERR_NO_USER_BY_ID)
+		elif len(users2) > 1:
+			return rp.Reply(rp.types.ERR_AMBIGUOUS_ID)
+		user2 = users2[0]
 	elif username2 is not None:
 		user2 = getUserByName(username2)
 		if user2 is None:
@@ -616,10 +915,14 @@ def uncooldown_user(user, oid2=None, username2=None):
 
 	if not user2.isInCooldown():
 		return rp.Reply(rp.types.ERR_NOT_IN_COOLDOWN)
-	with db.modifyUser(id=user2.id) as user2:
+	was_until = None
+	def f(user2):
+		nonlocal was_until
 		user2.removeWarning()
 		was_until = user2.cooldownUntil
 		user2.cooldownUntil = None
+	user2 = db.updateUser(user2.id, f)
+	stats.update(user2)
 	logging.info("%s removed cooldown from %s (was until %s)", user, user2, format_datetime(was_until))
 	return rp.Reply(rp.types.SUCCESS)
 
@@ -630,19 +933,23 @@ def blacklist_user(user, msid, reason, del_all=False):
 	if cm is None or cm.user_id is None:
 		return rp.Reply(rp.types.ERR_NOT_IN_CACHE)
 
-	with db.modifyUser(id=cm.user_id) as user2:
-		if user2.rank >= user.rank:
-			return
-		user2.setBlacklisted(reason)
+	def f(user2):
+		if user2.rank < user.rank:
+			user2.setBlacklisted(reason)
+	user2 = db.updateUser(cm.user_id, f)
+	if user2.rank >= user.rank:
+		return
+	recipients.update(user2)
+	stats.update(user2)
 	cm.warned = True
+	ch.updateMessage(msid)
 	Sender.stop_invoked(user2, True) # do this before queueing new messages below
 	_push_system_message(
 		rp.Reply(rp.types.ERR_BLACKLISTED, reason=reason, contact=blacklist_contact),
 		who=user2, reply_to=msid)
 	if del_all:
 		msgs = ch.getMessages(cm.user_id)
-		for cm2 in msgs:
-			Sender.delete([cm2])
+		Sender.delete(list(msgs))
 		logging.info("%s was blacklisted by %s and all his messages were deleted for: %s", user2, user, reason)
 		return rp.Reply(rp.types.SUCCESS_BLACKLIST_DELETEALL, id=user2.getObfuscatedId(), count=len(msgs))
 	else:
@@ -656,44 +963,41 @@ def modify_karma(user, msid, amount):
 	if cm is None or cm.user_id is None:
 		return rp.Reply(rp.types.ERR_NOT_IN_CACHE)
 	params = {"karma_is_pats": karma_is_pats}
-	if cm.hasUpvoted(user):
-		return rp.Reply(rp.types.ERR_ALREADY_VOTED_UP, **params)
-	if cm.hasDownvoted(user):
-		return rp.Reply(rp.types.ERR_ALREADY_VOTED_DOWN, **params)
 	if user.id == cm.user_id:
 		return rp.Reply(rp.types.ERR_VOTE_OWN_MESSAGE, **params)
-	if amount > 0:
-		# enforce upvoting cooldown
-		if vote_up_interval.total_seconds() > 1:
-			last_used = vote_up_last_used.get(user.id, None)
-			if last_used and (datetime.now() - last_used) < vote_up_interval:
+	with votes_lock:
+		if cm.hasUpvoted(user):
+			return rp.Reply(rp.types.ERR_ALREADY_VOTED_UP, **params)
+		if cm.hasDownvoted(user):
+			return rp.Reply(rp.types.ERR_ALREADY_VOTED_DOWN, **params)
+		if amount > 0:
+			# enforce upvoting cooldown
+			if not rate_limits["vote_up"].use(user.id):
 				return rp.Reply(rp.types.ERR_SPAMMY_VOTE_UP, **params)
-			vote_up_last_used[user.id] = datetime.now()
 
-		cm.addUpvote(user)
-	elif amount < 0:
-		# enforce downvoting cooldown
-		if vote_down_interval.total_seconds() > 1:
-			last_used = vote_down_last_used.get(user.id, None)
-			if last_used and (datetime.now() - last_used) < vote_down_interval:
+			cm.addUpvote(user)
+		elif amount < 0:
+			# enforce downvoting cooldown
+			if not rate_limits["vote_down"].use(user.id):
 				return rp.Reply(rp.types.ERR_SPAMMY_VOTE_DOWN, **params)
-			vote_down_last_used[user.id] = datetime.now()
 
-		cm.addDownvote(user)
-	else:
-		return
+			cm.addDownvote(user)
+		else:
+			return
+		# the vote is in the karma ledger before the voter can be saved
+		# with the message, see Database.addKarma()
+		karma = db.addKarma(cm.user_id, KARMA_PLUS_ONE * amount)
+	ch.updateMessage(msid)
 
+	old_level = getKarmaLevel(karma - KARMA_PLUS_ONE * amount)
+	new_level = getKarmaLevel(karma)
 	user2 = db.getUser(id=cm.user_id)
-	with db.modifyUser(id=cm.user_id) as user2:
-		old_level = getKarmaLevel(user2.karma)
-		user2.karma += KARMA_PLUS_ONE * amount
-		new_level = getKarmaLevel(user2.karma)
 	if not user2.hideKarma:
 		_push_system_message(rp.Reply(rp.types.KARMA_NOTIFICATION, count=amount, **params), who=user2, reply_to=msid)
 		if old_level < new_level:
-			_push_system_message(rp.Reply(rp.types.KARMA_LEVEL_UP, level=getKarmaLevelName(user2.karma), **params), who=user2)
+			_push_system_message(rp.Reply(rp.types.KARMA_LEVEL_UP, level=getKarmaLevelName(karma), **params), who=user2)
 		if old_level > new_level:
-			_push_system_message(rp.Reply(rp.types.KARMA_LEVEL_DOWN, level=getKarmaLevelName(user2.karma), **params), who=user2)
+			_push_system_message(rp.Reply(rp.types.KARMA_LEVEL_DOWN, level=getKarmaLevelName(karma), **params), who=user2)
 	if amount > 0:
 		return rp.Reply(rp.types.KARMA_VOTED_UP, bot_name=bot_name, **params)
 	elif amount < 0:
@@ -717,11 +1021,8 @@ def prepare_user_message(user: User, msg_score, *, is_media=False, signed=False,
 		return rp.Reply(rp.types.ERR_SPAMMY)
 
 	# enforce signing cooldown
-	if (signed or ksigned) and sign_interval.total_seconds() > 1:
-		last_used = sign_last_used.get(user.id, None)
-		if last_used and (datetime.now() - last_used) < sign_interval:
-			return rp.Reply(rp.types.ERR_SPAMMY_SIGN)
-		sign_last_used[user.id] = datetime.now()
+	if (signed or ksigned) and not rate_limits["sign"].use(user.id):
+		return rp.Reply(rp.types.ERR_SPAMMY_SIGN)
 
 	return ch.assignMessageId(CachedMessage(user.id))
 
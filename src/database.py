@@ -2,9 +2,15 @@ import logging
 import os
 import json
 import sqlite3
-from datetime import date, datetime, timedelta, timezone
+import calendar
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from datetime import date, datetime, timedelta
+from queue import Queue, Empty
 from random import randint
-from threading import RLock
+from threading import Lock, RLock
 
 from src.globals import *
 
@@ -21,9 +27,36 @@ USER_PROPS = (
 	"cooldownUntil", "blacklistReason", "warnings", "warnExpiry", "karma",
 	"hideKarma", "debugEnabled", "tripcode"
 )
+TOUCH_PROPS = ("username", "realname", "lastActive")
+# these are held as epoch timestamps and only turned into datetimes on access
+USER_DATE_PROPS = ("joined", "left", "lastActive", "cooldownUntil", "warnExpiry")
+USER_SLOTS = tuple(("_" + prop) if prop in USER_DATE_PROPS else prop for prop in USER_PROPS)
+USER_SLOT = dict(zip(USER_PROPS, USER_SLOTS))
+
+# Timestamps are seconds since the epoch, treating the naive local datetimes
+# used everywhere else as if they were UTC (same as the JSON backend).
+
+def toEpoch(dt):
+	return calendar.timegm(dt.timetuple())
+
+def fromEpoch(t):
+	return datetime.utcfromtimestamp(t)
+
+def epochNow():
+	return calendar.timegm(time.localtime())
+
+def _epochProperty(slot):
+	def get(self):
+		t = getattr(self, slot)
+		return None if t is None else fromEpoch(t)
+	def set(self, value):
+		if isinstance(value, datetime):
+			value = toEpoch(value)
+		setattr(self, slot, value)
+	return property(get, set)
 
 class User():
-	__slots__ = USER_PROPS
+	__slots__ = USER_SLOTS
 	def __init__(self):
 		self.id = None # int
 		self.username = None # str?
@@ -46,6 +79,24 @@ class User():
 		return NotImplemented
 	def __str__(self):
 		return "<User id=%d aka %r>" % (self.id, self.getFormattedName())
+	# builds a user from values in the order of USER_PROPS
+	@staticmethod
+	def fromTuple(t):
+		user = User.__new__(User)
+		(user.id, user.username, user.realname, user.rank, user._joined,
+			user._left, user._lastActive, user._cooldownUntil, user.blacklistReason,
+			user.warnings, user._warnExpiry, user.karma, user.hideKarma,
+			user.debugEnabled, user.tripcode) = t
+		return user
+	# value of a property as it is stored (i.e. epochs instead of datetimes)
+	def getRaw(self, prop):
+		return getattr(self, USER_SLOT[prop])
+	def snapshot(self):
+		return tuple(getattr(self, slot) for slot in USER_SLOTS)
+	# which fields differ from an earlier snapshot
+	def changedFields(self, snapshot):
+		return tuple(prop for prop, slot, value in zip(USER_PROPS, USER_SLOTS, snapshot)
+			if getattr(self, slot) != value)
 	def defaults(self):
 		self.rank = RANKS.user
 		self.joined = datetime.now()
@@ -55,17 +106,17 @@ class User():
 		self.hideKarma = False
 		self.debugEnabled = False
 	def isJoined(self):
-		return self.left is None
-	def isInCooldown(self):
-		return self.cooldownUntil is not None and self.cooldownUntil >= datetime.now()
+		return self._left is None
+	def isInCooldown(self, now=None):
+		if now is None:
+			now = epochNow()
+		return self._cooldownUntil is not None and self._cooldownUntil >= now
+	def isActiveSince(self, t):
+		return self._lastActive is not None and self._lastActive > t
 	def isBlacklisted(self):
 		return self.rank < 0
 	def getObfuscatedId(self):
-		salt = date.today().toordinal()
-		if salt & 0xff == 0: salt >>= 8 # zero bits are bad for hashing
-		value = (self.id * salt) & 0xffffff
-		alpha = "0123456789abcdefghijklmnopqrstuv"
-		return ''.join(alpha[n%32] for n in (value, value>>5, value>>10, value>>15))
+		return getObfuscatedId(self.id)
 	def getObfuscatedKarma(self):
 		offset = round(abs(self.karma * 0.2) + 2)
 		return self.karma + randint(0, offset + 1) - offset
@@ -74,12 +125,7 @@ class User():
 			return "@" + self.username
 		return self.realname
 	def getMessagePriority(self):
-		inactive_min = (datetime.now() - self.lastActive) / timedelta(minutes=1)
-		c1 = max(RANKS.values()) - max(self.rank, 0)
-		c2 = int(inactive_min) & 0xffff
-		# lower value means higher priority
-		# in this case: prioritize by higher rank, then by lower inactivity time
-		return c1 << 16 | c2
+		return getMessagePriority(self.rank, self.lastActive)
 	def setLeft(self, v=True):
 		self.left = datetime.now() if v else None
 	def setBlacklisted(self, reason):
@@ -107,6 +153,39 @@ class User():
 		else:
 			self.warnExpiry = None
 
+for prop in USER_DATE_PROPS:
+	setattr(User, prop, _epochProperty("_" + prop))
+
+# obfuscated ids are 4 characters encoding 20 bits of a hash that changes daily
+
+OID_ALPHABET = "0123456789abcdefghijklmnopqrstuv"
+
+def getObfuscatedIdSalt():
+	salt = date.today().toordinal()
+	if salt & 0xff == 0: salt >>= 8 # zero bits are bad for hashing
+	return salt
+
+def getObfuscatedIdValue(id, salt):
+	return (id * salt) & 0xfffff
+
+def getObfuscatedId(id):
+	value = getObfuscatedIdValue(id, getObfuscatedIdSalt())
+	return ''.join(OID_ALPHABET[n%32] for n in (value, value>>5, value>>10, value>>15))
+
+# reverse of the string encoding above, returns None if invalid
+def parseObfuscatedId(oid):
+	if len(oid) != 4 or any(c not in OID_ALPHABET for c in oid):
+		return None
+	return sum(OID_ALPHABET.index(c) << (5 * i) for i, c in enumerate(oid))
+
+def getMessagePriority(rank, lastActive):
+	inactive_min = (datetime.now() - lastActive) / timedelta(minutes=1)
+	c1 = max(RANKS.values()) - max(rank, 0)
+	c2 = int(inactive_min) & 0xffff
+	# lower value means higher priority
+	# in this case: prioritize by higher rank, then by lower inactivity time
+	return c1 << 16 | c2
+
 # abstract db
 
 class ModificationContext():
@@ -124,35 +203,279 @@ class ModificationContext():
 		if self.lock is not None:
 			self.lock.release()
 
+# Bounded LRU cache of users as read from the backend. It holds snapshots
+# (see User.snapshot) so that every reader gets its own User object.
+
+class UserCache():
+	def __init__(self, size):
+		self.lock = Lock()
+		self.size = size
+		self.entries = OrderedDict() # id -> snapshot
+		self.writes = 0 # number of put() calls, see fill()
+		self.hits = 0
+		self.misses = 0
+	def get(self, id):
+		with self.lock:
+			snap = self.entries.get(id)
+			if snap is None:
+				self.misses += 1
+				return None
+			self.hits += 1
+			self.entries.move_to_end(id)
+		return User.fromTuple(snap)
+	def _insert(self, id, snap):
+		self.entries[id] = snap
+		self.entries.move_to_end(id)
+		if len(self.entries) > self.size:
+			self.entries.popitem(last=False)
+	# after something was written
+	def put(self, user):
+		with self.lock:
+			self.writes += 1
+			self._insert(user.id, user.snapshot())
+	# after a read, `writes` must be the value from before it started so that
+	# it can't overwrite anything newer
+	def fill(self, user, writes):
+		with self.lock:
+			if writes == self.writes:
+				self._insert(user.id, user.snapshot())
+	def touch(self, d):
+		with self.lock:
+			self.writes += 1
+			for id, touch in d.items():
+				user = self.entries.get(id)
+				if user is None:
+					continue
+				user = User.fromTuple(user)
+				user.username, user.realname, user.lastActive = touch
+				self.entries[id] = user.snapshot()
+	def addKarma(self, d):
+		with self.lock:
+			self.writes += 1
+			for id, amount in d.items():
+				user = self.entries.get(id)
+				if user is None:
+					continue
+				user = User.fromTuple(user)
+				user.karma += amount
+				self.entries[id] = user.snapshot()
+	def clear(self):
+		with self.lock:
+			self.writes += 1
+			self.entries.clear()
+	def getStats(self):
+		with self.lock:
+			total = self.hits + self.misses
+			return {"size": len(self.entries), "hits": self.hits, "misses": self.misses,
+				"rate": self.hits / total if total > 0 else 0.0}
+
 class Database():
 	def __init__(self):
 		self.lock = RLock()
+		self.cache = UserCache(USER_CACHE_SIZE)
+		self.touched = {} # user id -> (username, realname, lastActive epoch) not yet written
+		self.touched_lock = Lock()
+		self.karma = {} # user id -> karma change not yet written
+		self.karma_lock = Lock() # taken after self.lock, never before
+		self.versions = [0] * USER_VERSION_SLOTS # writes per (id % slots), see updateUser()
+		self.updates = 0
+		self.conflicts = 0
+		self.on_external_write = None # called after another process changed the db
 		assert self.__class__ != Database # do not instantiate directly
 	def register_tasks(self, sched):
 		raise NotImplementedError()
 	def close(self):
 		raise NotImplementedError()
 	def getUser(self, id=None):
+		if id is None:
+			raise ValueError()
+		return self._readUser(id)[0]
+	# the user as it is in the backend (or its cache), without pending changes
+	def _getUser(self, id):
 		raise NotImplementedError()
-	def setUser(self, id, user):
+	# `fields` limits which properties are written (default: all)
+	def setUser(self, id, user, fields=None):
 		raise NotImplementedError()
 	def addUser(self, user):
 		raise NotImplementedError()
 	def iterateUserIds(self):
 		raise NotImplementedError()
+	def getCacheStats(self):
+		return self.cache.getStats()
 	def getSystemConfig(self):
 		raise NotImplementedError()
 	def setSystemConfig(self, config):
 		raise NotImplementedError()
-	def iterateUsers(self):
+	# `fields` is a hint that only these properties are needed, the users
+	# returned might not have the others set
+	def iterateUsers(self, fields=None):
 		with self.lock:
 			l = list(self.getUser(id=id) for id in self.iterateUserIds())
 		yield from l
-	def modifyUser(self, **kwargs):
+	# Targeted queries, backends should override these with something
+	# better than looking at every single user.
+	def findUserByName(self, username):
+		username = username.lower()
+		# there *should* only be a single joined user with a given username
+		for user in self.iterateUsers(fields=("username", "left")):
+			if not user.isJoined():
+				continue
+			if user.username is not None and user.username.lower() == username:
+				return self.getUser(id=user.id)
+		raise KeyError()
+	def countUsers(self):
+		now = epochNow()
+		d = {"active": 0, "inactive": 0, "blacklisted": 0, "cooldown": 0}
+		for user in self.iterateUsers(fields=("rank", "left", "cooldownUntil")):
+			if user.isBlacklisted():
+				d["blacklisted"] += 1
+			elif not user.isJoined():
+				d["inactive"] += 1
+			else:
+				d["active"] += 1
+			if user.isInCooldown(now):
+				d["cooldown"] += 1
+		return d
+	def countActiveUsers(self, since):
+		since = toEpoch(since)
+		return sum(1 for user in self.iterateUsers(fields=("lastActive", ))
+			if user.isActiveSince(since))
+	# joined users whose warnings have expired at `now`
+	def iterateExpiredWarnings(self, now):
+		now = toEpoch(now)
+		for user in self.iterateUsers():
+			if user.isJoined() and user._warnExpiry is not None and now >= user._warnExpiry:
+				yield user
+	# The lock is only held for writing: `func` gets the user to change and
+	# its changes are written unless someone else wrote the user in the
+	# meantime, in which case it is called again on a fresh copy. Returns the
+	# user as written.
+	def updateUser(self, id, func):
+		while True:
+			user, pending, version = self._readUser(id)
+			orig = user.snapshot()
+			func(user)
+			with self.lock:
+				if self.versions[id % USER_VERSION_SLOTS] != version:
+					self.conflicts += 1
+					continue
+				self._commitUser(user, orig, pending)
+			return user
+	def getUpdateStats(self):
+		return {"updates": self.updates, "conflicts": self.conflicts}
+	# must be called with the lock held
+	def _commitUser(self, user, orig, pending):
+		touch, karma = pending
+		fields = set(user.changedFields(orig))
+		if len(fields) == 0:
+			return # nothing to write
+		# `user` includes the pending changes it was read with, they're
+		# written along so that the cache only ever holds what was written
+		if touch is not None:
+			fields.update(TOUCH_PROPS)
+		if karma != 0:
+			fields.add("karma")
+		slot = user.id % USER_VERSION_SLOTS
+		with self.karma_lock:
+			self.versions[slot] += 1
+			self._forgetKarma({user.id: karma})
+			self.setUser(user.id, user, tuple(fields))
+			self.versions[slot] += 1
+		self.updates += 1
+		self._forgetTouches({user.id: touch})
+	# Activity updates (username, realname, lastActive) are frequent and only
+	# buffered here, they're written in batches by flushTouches().
+	def touchUser(self, user):
+		with self.touched_lock:
+			self.touched[user.id] = (user.username, user.realname, user._lastActive)
+	def flushTouches(self):
 		with self.lock:
-			user = self.getUser(**kwargs)
-			callback = lambda newuser: self.setUser(user.id, newuser)
-			return ModificationContext(user, callback, self.lock)
+			with self.touched_lock:
+				d = self.touched.copy()
+			if len(d) > 0:
+				self._writeTouches(d)
+			for id in d.keys():
+				self.versions[id % USER_VERSION_SLOTS] += 2 # see _readUser()
+			self._forgetTouches(d)
+	def _forgetTouches(self, d):
+		with self.touched_lock:
+			for id, touch in d.items():
+				# keep it if it was touched again in the meantime
+				if touch is not None and self.touched.get(id) is touch:
+					del self.touched[id]
+	def _writeTouches(self, d):
+		raise NotImplementedError()
+	# Karma votes work similarly: each one is only appended to a ledger,
+	# they add up per user in memory and are applied as a single
+	# `karma + amount` for each user by flushKarma(). Votes still in the
+	# ledger after a crash are applied when the database is opened again.
+	# Returns the user's new karma.
+	def addKarma(self, id, amount):
+		while True:
+			user, pending, version = self._readUser(id)
+			with self.lock:
+				with self.karma_lock:
+					# nothing may have changed since the user was read
+					if self.versions[id % USER_VERSION_SLOTS] != version:
+						continue
+					if self.karma.get(id, 0) != pending[1]:
+						continue
+					self._appendKarma(id, amount)
+					self.karma[id] = pending[1] + amount
+					return user.karma + amount
+	def flushKarma(self):
+		with self.lock:
+			with self.karma_lock:
+				d = self.karma.copy()
+				if len(d) == 0:
+					return
+				slots = set(id % USER_VERSION_SLOTS for id in d.keys())
+				for slot in slots:
+					self.versions[slot] += 1
+				self._forgetKarma(d)
+				self._writeKarma(d)
+				for slot in slots:
+					self.versions[slot] += 1
+	# Must be called with karma_lock held, before the karma is written:
+	# whatever is still in self.karma then is what stays in the ledger.
+	def _forgetKarma(self, d):
+		for id, amount in d.items():
+			left = self.karma.get(id, 0) - amount
+			if left == 0:
+				self.karma.pop(id, None)
+			else:
+				self.karma[id] = left
+	def _appendKarma(self, id, amount):
+		raise NotImplementedError()
+	def _writeKarma(self, d):
+		raise NotImplementedError()
+	# Returns the user with pending changes applied, those changes and the
+	# version it was read at. Writes of karma increment the version before
+	# and after (holding karma_lock), so an odd version means one is in
+	# progress and a read that overlaps one is done again instead of
+	# counting the same votes twice.
+	def _readUser(self, id):
+		slot = id % USER_VERSION_SLOTS
+		while True:
+			version = self.versions[slot]
+			if version % 2 == 1:
+				with self.karma_lock:
+					pass # wait for the write to finish
+				continue
+			user = self._getUser(id)
+			pending = (self.touched.get(id), self.karma.get(id, 0))
+			if self.versions[slot] == version:
+				return self._applyPending(user, pending), pending, version
+	# backends pass users they read through this so they see pending changes
+	def _applyPending(self, user, pending=None):
+		if pending is None:
+			pending = (self.touched.get(user.id), self.karma.get(user.id, 0))
+		touch, karma = pending
+		if touch is not None:
+			user.username, user.realname, user.lastActive = touch
+		if karma != 0 and hasattr(user, "karma"):
+			user.karma += karma
+		return user
 	def modifySystemConfig(self):
 		with self.lock:
 			config = self.getSystemConfig()
@@ -161,20 +484,39 @@ class Database():
 
 # JSON implementation
 
+# The whole database is kept in memory. Changes are appended to a journal
+# file next to it, which is merged back into the main file (compaction) on
+# startup, periodically and on shutdown.
+
 class JSONDatabase(Database):
 	def __init__(self, path):
 		super(JSONDatabase, self).__init__()
 		self.path = path
-		self.db = {"systemConfig": None, "users": []}
+		self.journal_path = path + ".journal"
+		self.systemConfig = None # dict
+		self.users = {} # id -> dict
+		self.journal = None # file object
+		self.journal_len = 0 # lines written since the last compaction
 		try:
 			self._load()
 		except FileNotFoundError as e:
 			pass
+		self._replay()
+		self.compact()
 		logging.warning("The JSON backend is meant for development only!")
 	def register_tasks(self, sched):
-		return
+		sched.register(self.flushTouches, seconds=ACTIVITY_FLUSH_SECONDS)
+		sched.register(self.flushKarma, seconds=ACTIVITY_FLUSH_SECONDS)
+		def f():
+			if self.journal_len > 0:
+				self.compact()
+		sched.register(f, minutes=JSON_COMPACT_MINUTES)
 	def close(self):
-		return
+		self.flushTouches()
+		self.flushKarma()
+		self.compact()
+		with self.lock:
+			self.journal.close()
 	@staticmethod
 	def _systemConfigToDict(config):
 		return {"motd": config.motd}
@@ -189,13 +531,7 @@ class JSONDatabase(Database):
 		props = ["id", "username", "realname", "rank", "joined", "left",
 			"lastActive", "cooldownUntil", "blacklistReason", "warnings",
 			"warnExpiry", "karma", "hideKarma", "debugEnabled", "tripcode"]
-		d = {}
-		for prop in props:
-			value = getattr(user, prop)
-			if isinstance(value, datetime):
-				value = int(value.replace(tzinfo=timezone.utc).timestamp())
-			d[prop] = value
-		return d
+		return {prop: user.getRaw(prop) for prop in props}
 	@staticmethod
 	def _userFromDict(d):
 		if d is None: return None
@@ -209,70 +545,214 @@ class JSONDatabase(Database):
 		for prop, default in props_d:
 			setattr(user, prop, d.get(prop, default))
 		for prop in dateprops:
-			if d[prop] is not None:
-				setattr(user, prop, datetime.utcfromtimestamp(d[prop]))
+			setattr(user, prop, d[prop]) # epochs, like in the file
 		return user
 	def _load(self):
 		with self.lock:
 			with open(self.path, "r") as f:
-				self.db = json.load(f)
-	def _save(self):
+				db = json.load(f)
+			self.systemConfig = db["systemConfig"]
+			self.users = {u["id"]: u for u in db["users"]}
+	def _replay(self):
+		with self.lock:
+			try:
+				f = open(self.journal_path, "r")
+			except FileNotFoundError as e:
+				return
+			with f:
+				for line in f:
+					try:
+						entry = json.loads(line)
+					except ValueError as e:
+						break # incomplete line at the end after a crash
+					self._apply(entry)
+	def _apply(self, entry):
+		if "systemConfig" in entry:
+			self.systemConfig = entry["systemConfig"]
+		elif "vote" in entry:
+			d = entry["vote"]
+			if d["id"] in self.users:
+				self.users[d["id"]]["karma"] += d["amount"]
+		else:
+			d = entry["user"]
+			self.users.setdefault(d["id"], {}).update(d)
+	def _append(self, entries):
 		with self.lock:
+			for entry in entries:
+				self._apply(entry)
+			self.journal.write("".join(json.dumps(entry) + "\n" for entry in entries))
+			self.journal.flush()
+			self.journal_len += len(entries)
+			# don't let the journal grow much larger than the data itself
+			if self.journal_len > max(1000, len(self.users)):
+				self.compact()
+	# write everything into the main file and start a new journal
+	def compact(self):
+		with self.lock:
+			db = {"systemConfig": self.systemConfig, "users": list(self.users.values())}
 			with open(self.path + "~", "w") as f:
-				json.dump(self.db, f)
+				json.dump(db, f)
 			os.replace(self.path + "~", self.path)
-	def getUser(self, id=None):
-		if id is None:
-			raise ValueError()
+			if self.journal is not None:
+				self.journal.close()
+			self.journal = open(self.journal_path, "w")
+			self.journal_len = 0
+			# votes that aren't applied yet have to stay in the journal
+			for id, amount in self.karma.items():
+				self._writeVote(id, amount)
+	def _writeVote(self, id, amount):
+		self.journal.write(json.dumps({"vote": {"id": id, "amount": amount}}) + "\n")
+		self.journal.flush()
+		self.journal_len += 1
+	def _getUser(self, id):
+		user = self.cache.get(id)
+		if user is not None:
+			return user
 		with self.lock:
-			gen = (u for u in self.db["users"] if u["id"] == id)
-			try:
-				return JSONDatabase._userFromDict(next(gen))
-			except StopIteration as e:
+			d = self.users.get(id)
+			if d is None:
 				raise KeyError()
-	def setUser(self, id, newuser):
-		newuser = JSONDatabase._userToDict(newuser)
+			user = JSONDatabase._userFromDict(d)
+			self.cache.fill(user, self.cache.writes)
+			return user
+	def setUser(self, id, newuser, fields=None):
+		d = JSONDatabase._userToDict(newuser)
+		if fields is not None:
+			d = {k: d[k] for k in fields}
+		d["id"] = id
 		with self.lock:
-			for i, user in enumerate(self.db["users"]):
-				if user["id"] == id:
-					self.db["users"][i] = newuser
-					self._save()
-					return
+			if id in self.users:
+				self._append([{"user": d}])
+				if "karma" in d and id in self.karma:
+					# the votes not included in it (see _forgetKarma())
+					self._writeVote(id, self.karma[id])
+				self.cache.put(newuser)
 	def addUser(self, newuser):
 		newuser = JSONDatabase._userToDict(newuser)
+		self._append([{"user": newuser}])
+	def _writeTouches(self, d):
+		entries = []
+		for id, touch in d.items():
+			entries.append({"user": {
+				"id": id, "username": touch[0], "realname": touch[1],
+				"lastActive": touch[2],
+			}})
 		with self.lock:
-			self.db["users"].append(newuser)
-			self._save()
+			self._append(list(e for e in entries if e["user"]["id"] in self.users))
+			self.cache.touch(d)
+	def _writeKarma(self, d):
+		with self.lock:
+			entries = []
+			for id, amount in d.items():
+				if id in self.users:
+					karma = self.users[id]["karma"] + amount
+					entries.append({"user": {"id": id, "karma": karma}})
+			self._append(entries)
+			self.cache.addKarma(d)
+	# votes are only journaled, they're applied to self.users by flushKarma()
+	# (or when replaying the journal)
+	def _appendKarma(self, id, amount):
+		with self.lock:
+			self._writeVote(id, amount)
 	def iterateUserIds(self):
 		with self.lock:
-			l = list(u["id"] for u in self.db["users"])
+			l = list(self.users.keys())
+		yield from l
+	def iterateUsers(self, fields=None):
+		with self.lock:
+			l = list(self._applyPending(JSONDatabase._userFromDict(d)) for d in self.users.values())
 		yield from l
 	def getSystemConfig(self):
 		with self.lock:
-			return JSONDatabase._systemConfigFromDict(self.db["systemConfig"])
+			return JSONDatabase._systemConfigFromDict(self.systemConfig)
 	def setSystemConfig(self, config):
-		with self.lock:
-			self.db["systemConfig"] = JSONDatabase._systemConfigToDict(config)
-			self._save()
+		self._append([{"systemConfig": JSONDatabase._systemConfigToDict(config)}])
 
 # SQLite implementation
 
+# The database runs in WAL mode: all writes go through a single connection
+# (serialized by self.lock) and are committed immediately, while reads use
+# a small pool of connections and run in parallel with writes and each other.
+
+SQLITE_USER_COLUMNS = ", ".join("`%s`" % prop for prop in USER_PROPS)
+SQLITE_CHUNK_SIZE = 1000 # rows read at once when iterating
+
+SQLITE_PRAGMAS = {
+	"synchronous": "NORMAL", # durable enough with WAL and much cheaper
+	"mmap_size": 64 * 1024 * 1024,
+	"cache_size": -8000, # in KiB when negative
+}
+
 class SQLiteDatabase(Database):
-	def __init__(self, path):
+	def __init__(self, path, pragmas={}, readers=4):
 		super(SQLiteDatabase, self).__init__()
-		self.db = sqlite3.connect(path, check_same_thread=False,
-			detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-		self.db.row_factory = sqlite3.Row
+		self.path = path
+		self.pragmas = dict(SQLITE_PRAGMAS, **pragmas)
+		self.config_cache = None # dict, as in the system_config table
+		self.db = self._connect()
+		self.db.execute("PRAGMA journal_mode=WAL")
 		self._ensure_schema()
+		self.db.commit()
+		self.data_version = self._dataVersion()
+		self.readers = Queue()
+		self.readers_left = readers # how many more may still be opened
+		self.readers_lock = Lock()
 	def register_tasks(self, sched):
-		def f():
-			with self.lock:
-				self.db.commit()
-		sched.register(f, seconds=5)
+		sched.register(self.flushTouches, seconds=ACTIVITY_FLUSH_SECONDS)
+		sched.register(self.flushKarma, seconds=ACTIVITY_FLUSH_SECONDS)
+		sched.register(self.checkExternalWrites, seconds=EXTERNAL_WRITE_CHECK_SECONDS)
+	def _dataVersion(self):
+		return self.db.execute("PRAGMA data_version").fetchone()[0]
+	# Other processes (util/blacklist.py) may write to the database, which
+	# the cached users and system config wouldn't know about. SQLite changes
+	# the data_version of a connection whenever some other one commits.
+	def checkExternalWrites(self):
+		with self.lock:
+			version = self._dataVersion()
+			if version == self.data_version:
+				return
+			self.data_version = version
+			self.cache.clear()
+			self.config_cache = None
+			# make updates that are in progress start over
+			for i in range(USER_VERSION_SLOTS):
+				self.versions[i] += 2
+		logging.info("Database was changed by another process")
+		if self.on_external_write is not None:
+			self.on_external_write()
 	def close(self):
 		with self.lock:
+			self.flushTouches()
+			self.flushKarma()
 			self.db.commit()
 			self.db.close()
+		while True:
+			try:
+				self.readers.get_nowait().close()
+			except Empty:
+				break
+	def _connect(self, readonly=False):
+		conn = sqlite3.connect(self.path, check_same_thread=False)
+		conn.row_factory = sqlite3.Row
+		for k, v in self.pragmas.items():
+			conn.execute("PRAGMA %s=%s" % (k, v))
+		if readonly:
+			conn.execute("PRAGMA query_only=1")
+		return conn
+	@contextmanager
+	def _reader(self):
+		try:
+			conn = self.readers.get_nowait()
+		except Empty:
+			with self.readers_lock:
+				new = self.readers_left > 0
+				if new:
+					self.readers_left -= 1
+			conn = self._connect(True) if new else self.readers.get()
+		try:
+			yield conn
+		finally:
+			self.readers.put(conn)
 	@staticmethod
 	def _systemConfigToDict(config):
 		return {"motd": config.motd}
@@ -284,97 +764,224 @@ class SQLiteDatabase(Database):
 		return config
 	@staticmethod
 	def _userToDict(user):
-		return {prop: getattr(user, prop) for prop in USER_PROPS}
+		return {prop: user.getRaw(prop) for prop in USER_PROPS}
 	@staticmethod
 	def _userFromRow(r):
-		user = User()
-		for prop in r.keys():
-			setattr(user, prop, r[prop])
+		return User.fromTuple(r)
+	@staticmethod
+	def _userFromColumns(fields, r):
+		user = User.__new__(User)
+		for prop, value in zip(fields, r):
+			setattr(user, prop, value)
 		return user
+	# Yields rows of a query in chunks ordered by id, the sql must contain
+	# "WHERE `id` > ?" and end in "ORDER BY `id` LIMIT ?". A connection is
+	# only held while a chunk is read.
+	def _iterate(self, sql, params=()):
+		last = -(1 << 63)
+		while True:
+			with self._reader() as conn:
+				rows = conn.execute(sql, (last, ) + params + (SQLITE_CHUNK_SIZE, )).fetchall()
+			yield from rows
+			if len(rows) < SQLITE_CHUNK_SIZE:
+				break
+			last = rows[-1][0]
 	def _ensure_schema(self):
 		def row_exists(table, name):
 			cur = self.db.execute("PRAGMA table_info(`" + table + "`);")
 			return any(row[1] == name for row in cur)
-
-		with self.lock:
-			# create initial schema
-			self.db.execute("""
-CREATE TABLE IF NOT EXISTS `system_config` (
-	`name` TEXT NOT NULL,
-	`value` TEXT NOT NULL,
-	PRIMARY KEY (`name`)
-);
-			""".strip())
-			self.db.execute("""
+		def row_type(table, name):
+			cur = self.db.execute("PRAGMA table_info(`" + table + "`);")
+			return next(row[2] for row in cur if row[1] == name)
+		users_schema = """
 CREATE TABLE IF NOT EXISTS `users` (
 	`id` BIGINT NOT NULL,
 	`username` TEXT,
 	`realname` TEXT NOT NULL,
 	`rank` INTEGER NOT NULL,
-	`joined` TIMESTAMP NOT NULL,
-	`left` TIMESTAMP,
-	`lastActive` TIMESTAMP NOT NULL,
-	`cooldownUntil` TIMESTAMP,
+	`joined` INTEGER NOT NULL,
+	`left` INTEGER,
+	`lastActive` INTEGER NOT NULL,
+	`cooldownUntil` INTEGER,
 	`blacklistReason` TEXT,
 	`warnings` INTEGER NOT NULL,
-	`warnExpiry` TIMESTAMP,
+	`warnExpiry` INTEGER,
 	`karma` INTEGER NOT NULL,
 	`hideKarma` TINYINT NOT NULL,
 	`debugEnabled` TINYINT NOT NULL,
 	`tripcode` TEXT,
 	PRIMARY KEY (`id`)
+);
+		""".strip()
+
+		with self.lock:
+			# create initial schema
+			self.db.execute("""
+CREATE TABLE IF NOT EXISTS `system_config` (
+	`name` TEXT NOT NULL,
+	`value` TEXT NOT NULL,
+	PRIMARY KEY (`name`)
+);
+			""".strip())
+			self.db.execute(users_schema)
+			self.db.execute("""
+CREATE TABLE IF NOT EXISTS `karma_ledger` (
+	`user` BIGINT NOT NULL,
+	`amount` INTEGER NOT NULL
 );
 			""".strip())
 			# migration
 			if not row_exists("users", "tripcode"):
 				self.db.execute("ALTER TABLE `users` ADD `tripcode` TEXT")
-	def getUser(self, id=None):
-		if id is None:
-			raise ValueError()
-		sql = "SELECT * FROM users WHERE id = ?"
+			if row_type("users", "joined") == "TIMESTAMP":
+				# timestamps used to be stored as text, rebuild the table with epochs
+				logging.info("Converting timestamps in the database, this may take a while")
+				cols = ", ".join(
+					("CAST(strftime('%%s', `%s`) AS INTEGER)" if prop in USER_DATE_PROPS else "`%s`") % prop
+					for prop in USER_PROPS)
+				self.db.execute("BEGIN")
+				self.db.execute("ALTER TABLE `users` RENAME TO `users_old`")
+				self.db.execute(users_schema)
+				self.db.execute("INSERT INTO `users` SELECT " + cols + " FROM `users_old`")
+				self.db.execute("DROP TABLE `users_old`")
+				self.db.commit()
+			# indexes
+			self.db.execute("CREATE INDEX IF NOT EXISTS `users_username` "
+				"ON `users`(lower(`username`)) WHERE `left` IS NULL")
+			self.db.execute("CREATE INDEX IF NOT EXISTS `users_warnExpiry` "
+				"ON `users`(`warnExpiry`) WHERE `warnExpiry` IS NOT NULL")
+			self.db.execute("CREATE INDEX IF NOT EXISTS `users_state` ON `users`(`rank`, `left`)")
+			self.db.execute("CREATE INDEX IF NOT EXISTS `users_lastActive` ON `users`(`lastActive`)")
+			self.db.execute("CREATE INDEX IF NOT EXISTS `users_cooldownUntil` "
+				"ON `users`(`cooldownUntil`) WHERE `cooldownUntil` IS NOT NULL")
+			# apply votes left over from a crash
+			self.db.execute("UPDATE users SET `karma` = `karma` + "
+				"(SELECT SUM(`amount`) FROM karma_ledger WHERE `user` = users.id) "
+				"WHERE id IN (SELECT `user` FROM karma_ledger)")
+			self.db.execute("DELETE FROM karma_ledger")
+	def _getUser(self, id):
+		user = self.cache.get(id)
+		if user is not None:
+			return user
+		sql = "SELECT " + SQLITE_USER_COLUMNS + " FROM users WHERE id = ?"
 		param = id
-		with self.lock:
-			cur = self.db.execute(sql, (param, ))
-			row = cur.fetchone()
+		writes = self.cache.writes
+		with self._reader() as conn:
+			row = conn.execute(sql, (param, )).fetchone()
 		if row is None:
 			raise KeyError()
-		return SQLiteDatabase._userFromRow(row)
-	def setUser(self, id, newuser):
-		newuser = SQLiteDatabase._userToDict(newuser)
-		del newuser['id'] # this is our primary key
+		user = SQLiteDatabase._userFromRow(row)
+		self.cache.fill(user, writes)
+		return user
+	@staticmethod
+	@lru_cache(maxsize=None)
+	def _updateSql(fields):
 		sql = "UPDATE users SET "
-		sql += ", ".join("`%s` = ?" % k for k in newuser.keys())
+		sql += ", ".join("`%s` = ?" % k for k in fields)
 		sql += " WHERE id = ?"
-		param = list(newuser.values()) + [id, ]
+		return sql
+	def setUser(self, id, newuser, fields=None):
+		if fields is None:
+			fields = USER_PROPS[1:] # id is our primary key
+		fields = tuple(sorted(fields)) # so the statement can be reused
+		sql = SQLiteDatabase._updateSql(fields)
+		param = list(newuser.getRaw(k) for k in fields) + [id, ]
 		with self.lock:
 			self.db.execute(sql, param)
+			if "karma" in fields:
+				# keep only the votes not included in it (see _forgetKarma())
+				self.db.execute("DELETE FROM karma_ledger WHERE `user` = ?", (id, ))
+				if id in self.karma:
+					self.db.execute("INSERT INTO karma_ledger VALUES (?, ?)", (id, self.karma[id]))
+			self.db.commit()
+			self.cache.put(newuser)
 	def addUser(self, newuser):
-		newuser = SQLiteDatabase._userToDict(newuser)
+		d = SQLiteDatabase._userToDict(newuser)
 		sql = "INSERT INTO users("
-		sql += ", ".join("`%s`" % k for k in newuser.keys())
+		sql += ", ".join("`%s`" % k for k in d.keys())
 		sql += ") VALUES ("
-		sql += ", ".join("?" for i in range(len(newuser)))
+		sql += ", ".join("?" for i in range(len(d)))
 		sql += ")"
-		param = list(newuser.values())
+		param = list(d.values())
 		with self.lock:
 			self.db.execute(sql, param)
-	def iterateUserIds(self):
-		sql = "SELECT `id` FROM users"
+			self.db.commit()
+			self.cache.put(newuser)
+	def _writeTouches(self, d):
+		sql = "UPDATE users SET `username` = ?, `realname` = ?, `lastActive` = ? WHERE id = ?"
+		param = list(touch + (id, ) for id, touch in d.items())
 		with self.lock:
-			cur = self.db.execute(sql)
-			l = cur.fetchall()
-		yield from l
-	def iterateUsers(self):
-		sql = "SELECT * FROM users"
+			self.db.executemany(sql, param)
+			self.db.commit()
+			self.cache.touch(d)
+	def _writeKarma(self, d):
+		sql = "UPDATE users SET `karma` = `karma` + ? WHERE id = ?"
+		param = list((amount, id) for id, amount in d.items())
 		with self.lock:
-			cur = self.db.execute(sql)
-			l = list(SQLiteDatabase._userFromRow(row) for row in cur)
+			self.db.executemany(sql, param)
+			# `d` is everything that was pending, see flushKarma()
+			self.db.execute("DELETE FROM karma_ledger")
+			self.db.commit()
+			self.cache.addKarma(d)
+	def _appendKarma(self, id, amount):
+		with self.lock:
+			self.db.execute("INSERT INTO karma_ledger VALUES (?, ?)", (id, amount))
+			self.db.commit()
+	def iterateUserIds(self):
+		sql = "SELECT `id` FROM users WHERE `id` > ? ORDER BY `id` LIMIT ?"
+		for row in self._iterate(sql):
+			yield row[0]
+	def iterateUsers(self, fields=None):
+		if fields is None:
+			sql = "SELECT " + SQLITE_USER_COLUMNS
+			func = SQLiteDatabase._userFromRow
+		else:
+			fields = ("id", ) + tuple(prop for prop in fields if prop != "id")
+			sql = "SELECT " + ", ".join("`%s`" % prop for prop in fields)
+			func = lambda row: SQLiteDatabase._userFromColumns(fields, row)
+		sql += " FROM users WHERE `id` > ? ORDER BY `id` LIMIT ?"
+		for row in self._iterate(sql):
+			yield self._applyPending(func(row))
+	def findUserByName(self, username):
+		self.flushTouches() # usernames might have changed
+		sql = "SELECT " + SQLITE_USER_COLUMNS + " FROM users WHERE lower(`username`) = ? AND `left` IS NULL"
+		with self._reader() as conn:
+			row = conn.execute(sql, (username.lower(), )).fetchone()
+		if row is None:
+			raise KeyError()
+		return self._applyPending(SQLiteDatabase._userFromRow(row))
+	def countUsers(self):
+		# each of these can be answered from an index alone
+		queries = {
+			"total": ("SELECT COUNT(*) FROM users", ()),
+			"blacklisted": ("SELECT COUNT(*) FROM users WHERE `rank` < 0", ()),
+			"active": ("SELECT COUNT(*) FROM users WHERE `rank` >= 0 AND `left` IS NULL", ()),
+			"cooldown": ("SELECT COUNT(*) FROM users WHERE `cooldownUntil` >= ?", (epochNow(), )),
+		}
+		with self._reader() as conn:
+			d = {k: conn.execute(*q).fetchone()[0] for k, q in queries.items()}
+		d["inactive"] = d.pop("total") - d["active"] - d["blacklisted"]
+		return d
+	def countActiveUsers(self, since):
+		self.flushTouches()
+		sql = "SELECT COUNT(*) FROM users WHERE `lastActive` > ?"
+		with self._reader() as conn:
+			return conn.execute(sql, (toEpoch(since), )).fetchone()[0]
+	def iterateExpiredWarnings(self, now):
+		sql = "SELECT " + SQLITE_USER_COLUMNS + " FROM users WHERE `warnExpiry` <= ? AND `left` IS NULL"
+		with self._reader() as conn:
+			l = list(self._applyPending(SQLiteDatabase._userFromRow(row))
+				for row in conn.execute(sql, (toEpoch(now), )))
 		yield from l
 	def getSystemConfig(self):
-		sql = "SELECT * FROM system_config"
-		with self.lock:
-			cur = self.db.execute(sql)
-			d = {row['name']: row['value'] for row in cur}
+		d = self.config_cache
+		if d is None:
+			sql = "SELECT * FROM system_config"
+			with self._reader() as conn:
+				d = {row['name']: row['value'] for row in conn.execute(sql)}
+			with self.lock:
+				if self.config_cache is None:
+					self.config_cache = d
 		return SQLiteDatabase._systemConfigFromDict(d)
 	def setSystemConfig(self, config):
 		d = SQLiteDatabase._systemConfigToDict(config)
@@ -382,3 +989,5 @@ CREATE TABLE IF NOT EXISTS `users` (
 		with self.lock:
 			for k, v in d.items():
 				self.db.execute(sql, (k, v))
+			self.db.commit()
+			self.config_cache = d
@@ -82,6 +82,18 @@ COOLDOWN_TIME_LINEAR_M = 4320 # continues 7d, 10d, 13d, 16d, ... (linear)
 COOLDOWN_TIME_LINEAR_B = 10080
 WARN_EXPIRE_HOURS = 7 * 24
 
+# Database
+ACTIVITY_FLUSH_SECONDS = 3 # how often buffered user activity is written
+JSON_COMPACT_MINUTES = 10 # how often the JSON db journal is merged into the main file
+USER_CACHE_SIZE = 10000 # users kept in memory to avoid reading them from the db
+USER_VERSION_SLOTS = 4096 # users sharing a slot only cause needless retries
+EXTERNAL_WRITE_CHECK_SECONDS = 1 # how often to look for changes by other processes
+
+# Message cache
+CACHE_EXPIRE_HOURS = 24
+CACHE_BUCKET_MINUTES = 10 # messages expire together in buckets of this size
+CACHE_FLUSH_SECONDS = 3 # how often the persistent cache is written
+
 # Karma related
 KARMA_PLUS_ONE = 1
 KARMA_WARN_PENALTY = 0 # Since we have downvote capability, we don't need/want this
@@ -90,7 +102,10 @@ KARMA_LEVELS = [-49, -4, 15, 40, 100, 200, 300, 500] # Minimum karma for differe
 # Spam limits
 SPAM_LIMIT = 3
 SPAM_LIMIT_HIT = 6
-SPAM_INTERVAL_SECONDS = 5
+SPAM_INTERVAL_SECONDS = 5 # scores decay by one per this many seconds
+SPAM_STRIPES = 16 # number of locks the scores are split over
+SPAM_EVICT_BATCH = 4 # max. stale scores dropped per message
+RATE_LIMIT_SAVE_MINUTES = 1 # how often sign/vote cooldowns are saved (if enabled)
 
 # Spam score calculation
 SCORE_STICKER = 1.5
@@ -26,6 +26,7 @@ class Reply():
 	def __init__(self, type, **kwargs):
 		self.type = type
 		self.kwargs = kwargs
+		self.rendered = None # (localization, text) cached by formatForTelegram()
 
 types = NumericEnum([
 	"CUSTOM",
@@ -70,6 +71,7 @@ types = NumericEnum([
 	"ERR_NOT_IN_CACHE",
 	"ERR_NO_USER",
 	"ERR_NO_USER_BY_ID",
+	"ERR_AMBIGUOUS_ID",
 	"ERR_ALREADY_WARNED",
 	"ERR_INVALID_DURATION",
 	"ERR_NOT_IN_COOLDOWN",
@@ -220,6 +222,7 @@ format_strs = {
 		),
 	types.ERR_NO_USER: em("No user found by that name!"),
 	types.ERR_NO_USER_BY_ID: em("No user found by that id! Note that all ids rotate every 24 hours."),
+	types.ERR_AMBIGUOUS_ID: em("More than one user has that id today, please use their username instead."),
 	types.ERR_COOLDOWN: em("Your cooldown expires at {until!t}"),
 	types.ERR_ALREADY_WARNED: em("A warning has already been issued for this message."),
 	types.ERR_INVALID_DURATION: em("You entered an invalid cooldown duration."),
@@ -368,16 +371,29 @@ format_strs = {
 		"<b>Local time:</b> {time}\n" + # Must not use "t" conversion
 		"\n" +
 		"<b>Cached messages:</b> {cached_msgs:n}\n" +
-		"<b>Recently-active users:</b> {active_users:n}"
+		"<b>Recently-active users:</b> {active_users:n}\n" +
+		"<b>User cache hit rate:</b> {user_cache_rate:.1%}\n" +
+		"<b>User update conflicts:</b> {db_conflicts:n}\n" +
+		"\n" +
+		"<b>Queued messages:</b> {queued_msgs:n}\n" +
+		"<b>Send threads:</b> {send_threads:n}\n" +
+		"<b>Delivery rate:</b> {send_rate:.1f} msg/s"
 }
 
 localization = {}
 
+# the result is cached in the Reply, so it's formatted only once even if it's
+# sent to many users (as long as the localization doesn't change)
 def formatForTelegram(m):
+	cached = m.rendered
+	if cached is not None and cached[0] is localization:
+		return cached[1]
 	s = localization.get(m.type)
 	if s is None:
 		s = format_strs[m.type]
 	if type(s).__name__ == "function":
 		s = s(**m.kwargs)
 	cls = localization.get("_FORMATTER_", CustomFormatter)
-	return cls().format(s, **m.kwargs)
+	s = cls().format(s, **m.kwargs)
+	m.rendered = (localization, s)
+	return s
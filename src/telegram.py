@@ -1,13 +1,14 @@
 import telebot
 import logging
 import time
-import json
 import re
+import asyncio
 from os import path
+from threading import Lock, BoundedSemaphore, Thread
 
 import src.core as core
 import src.replies as rp
-from src.util import MutablePriorityQueue, genTripcode
+from src.util import KeyedPriorityQueue, WorkerPool, genTripcode
 from src.globals import *
 
 # module constants
@@ -30,6 +31,9 @@ bot = None
 db = None
 ch = None
 message_queue = None
+send_pool = None
+rate_limiter = None
+async_sender = None
 registered_commands = {}
 
 # settings
@@ -38,18 +42,32 @@ allow_polls = None
 linked_network: dict = None
 
 def init(config, _db, _ch):
-	global bot, db, ch, message_queue, allow_documents, allow_polls, linked_network
+	global bot, db, ch, message_queue, send_pool, rate_limiter, async_sender, allow_documents, allow_polls, linked_network
 	if config["bot_token"] == "":
 		logging.error("No telegram token specified.")
 		exit(1)
 
 	logging.getLogger("urllib3").setLevel(logging.WARNING) # very noisy with debug otherwise
 	telebot.apihelper.READ_TIMEOUT = 20
+	if config.get("api_url"):
+		telebot.apihelper.API_URL = config["api_url"].rstrip("/") + "/bot{0}/{1}"
 
 	bot = telebot.TeleBot(config["bot_token"], threaded=False)
+	if config.get("async_transport", False):
+		try:
+			async_sender = AsyncSender(config["bot_token"],
+				int(config.get("async_connections", 50)), int(config.get("async_max_inflight", 200)))
+		except ImportError as e:
+			logging.error("The asyncio transport needs aiohttp to be installed.")
+			exit(1)
+		if config.get("api_url"):
+			__import__("telebot.asyncio_helper", fromlist=["asyncio_helper"]).API_URL = telebot.apihelper.API_URL
 	db = _db
 	ch = _ch
-	message_queue = MutablePriorityQueue()
+	message_queue = KeyedPriorityQueue(index="msid")
+	send_pool = WorkerPool(message_queue, send_item,
+		int(config.get("send_threads_min", 1)), int(config.get("send_threads_max", 8)))
+	rate_limiter = RateLimiter()
 
 	allow_contacts = config["allow_contacts"]
 	allow_documents = config["allow_documents"]
@@ -116,19 +134,19 @@ def register_tasks(sched):
 	# cache expiration
 	def task():
 		ids = ch.expire()
-		if len(ids) == 0:
-			return
-		n = 0
-		def f(item):
-			nonlocal n
-			if item.msid in ids:
-				n += 1
-				return True
-			return False
-		message_queue.delete(f)
+		n = sum(message_queue.deleteBy(msid) for msid in ids)
 		if n > 0:
 			logging.warning("Failed to deliver %d messages before they expired from cache.", n)
-	sched.register(task, hours=6) # (1/4) * cache duration
+	sched.register(task, minutes=CACHE_BUCKET_MINUTES)
+	# delivery statistics
+	def task():
+		send_pool.sample()
+		stats = send_pool.getStats()
+		logging.debug("Delivery: %d queued, %d/%d threads busy, %d in flight, %.1f msg/s",
+			stats["queued"], stats["busy"], stats["workers"], stats["inflight"], stats["rate"])
+	sched.register(task, minutes=1)
+	# rate limit state
+	sched.register(rate_limiter.cleanup, minutes=5)
 
 # Wraps a telegram user in a consistent class (used by core.py)
 class UserContainer():
@@ -171,22 +189,11 @@ def send_answer(ev, m, reply_to=False):
 		return
 
 	reply_to = ev.message_id if reply_to else None
-	def f(ev=ev, m=m):
-		while True:
-			try:
-				send_to_single_inner(ev.chat.id, m, reply_to=reply_to)
-			except telebot.apihelper.ApiException as e:
-				retry = check_telegram_exc(e, None)
-				if retry:
-					continue
-				return
-			break
-
 	try:
 		user = db.getUser(id=ev.from_user.id)
 	except KeyError as e:
 		user = None # happens on e.g. /start
-	put_into_queue(user, None, f)
+	put_into_queue(user, None, SendPayload(m, leave=False), reply_to, chat_id=ev.chat.id)
 
 # TODO: find a better place for this
 def allow_message_text(text):
@@ -338,21 +345,202 @@ def formatter_tripcoded_message(user: core.User, fmt: FormattedMessageBuilder):
 
 ###
 
+# Rate limiting according to the Bot API limits
+
+# allows `rate` requests per second with bursts of up to `burst` requests
+class TokenBucket():
+	__slots__ = ("rate", "burst", "tokens", "stamp", "until")
+	def __init__(self, rate, burst, now):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.stamp = now
+		self.until = 0 # paused until this time
+	def full(self, now):
+		return now >= self.until and self.tokens + (now - self.stamp) * self.rate >= self.burst
+	# seconds until a request can be made
+	def wait(self, now):
+		if now < self.until:
+			return self.until - now
+		self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+		self.stamp = now
+		if self.tokens >= 1:
+			return 0
+		return (1 - self.tokens) / self.rate
+	def take(self):
+		self.tokens -= 1
+	def pause(self, now, d):
+		self.until = max(self.until, now + d)
+		self.tokens = 0
+		self.stamp = self.until
+
+class RateLimiter():
+	# Telegram allows about 30 messages per second in total and one per
+	# second in a single chat (short bursts are tolerated).
+	# A 429 error pauses the chat it happened in and halves its rate, if
+	# several chats hit it at the same time the global bucket is the one that
+	# is exhausted and gets the same treatment.
+	# Reduced rates recover with every successfully sent message.
+	GLOBAL_RATE = 30
+	CHAT_RATE = 1
+	CHAT_BURST = 3
+	MIN_RATE = 1/60
+	RECOVER_STEP = 0.05
+	CONCURRENT_429_WINDOW = 1 # seconds
+	CONCURRENT_429_CHATS = 3
+	def __init__(self):
+		now = time.monotonic()
+		self.glob = TokenBucket(RateLimiter.GLOBAL_RATE, RateLimiter.GLOBAL_RATE, now)
+		self.chats = {} # chat id -> TokenBucket
+		self.recent_429 = {} # chat id -> time of last 429
+		self.lock = Lock()
+	def _bucket(self, chat_id, now):
+		b = self.chats.get(chat_id)
+		if b is None:
+			b = self.chats[chat_id] = TokenBucket(RateLimiter.CHAT_RATE, RateLimiter.CHAT_BURST, now)
+		return b
+	@staticmethod
+	def _recover(b, rate):
+		if b.rate < rate:
+			b.rate = min(rate, b.rate + rate * RateLimiter.RECOVER_STEP)
+	# Reserves a request to `chat_id` and returns 0, waits for the global
+	# budget if needed. Returns the seconds to wait if the chat has no budget.
+	def acquire(self, chat_id):
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				b = self._bucket(chat_id, now)
+				wait = b.wait(now)
+				if wait > 0:
+					return wait
+				wait = self.glob.wait(now)
+				if wait == 0:
+					b.take()
+					self.glob.take()
+					RateLimiter._recover(b, RateLimiter.CHAT_RATE)
+					RateLimiter._recover(self.glob, RateLimiter.GLOBAL_RATE)
+					return 0
+			time.sleep(wait)
+	# a 429 error asked us to wait `d` seconds, returns the delay for retrying
+	def penalize(self, chat_id, d):
+		with self.lock:
+			now = time.monotonic()
+			b = self._bucket(chat_id, now)
+			b.pause(now, d)
+			b.rate = max(RateLimiter.MIN_RATE, b.rate / 2)
+			self.recent_429[chat_id] = now
+			cutoff = now - RateLimiter.CONCURRENT_429_WINDOW
+			for k in list(self.recent_429.keys()):
+				if self.recent_429[k] < cutoff:
+					del self.recent_429[k]
+			if len(self.recent_429) >= RateLimiter.CONCURRENT_429_CHATS:
+				logging.debug("Global rate limit hit, pausing all chats for %ds", d)
+				self.glob.pause(now, d)
+				self.glob.rate = max(1, self.glob.rate / 2)
+				self.recent_429.clear()
+		return d
+	# forget about chats that are back to normal
+	def cleanup(self):
+		with self.lock:
+			now = time.monotonic()
+			for chat_id in list(self.chats.keys()):
+				b = self.chats[chat_id]
+				if b.rate >= RateLimiter.CHAT_RATE and b.full(now):
+					del self.chats[chat_id]
+
+###
+
+# Sending through the asyncio API, which keeps many requests in flight over a
+# bounded pool of keep-alive connections instead of blocking a thread for each.
+# Items still pass through rate_limiter first, so this can't go faster than
+# RateLimiter.GLOBAL_RATE, it only gets there with fewer threads when the API
+# is slow to respond.
+
+class AsyncSender():
+	def __init__(self, token, connections, max_inflight):
+		# optional dependency (aiohttp)
+		helper = __import__("telebot.asyncio_helper", fromlist=["asyncio_helper"])
+		AsyncTeleBot = __import__("telebot.async_telebot", fromlist=["AsyncTeleBot"]).AsyncTeleBot
+		helper.REQUEST_LIMIT = connections
+		self.ApiException = helper.ApiException
+		self.bot = AsyncTeleBot(token)
+		self.slots = BoundedSemaphore(max_inflight)
+		self.loop = asyncio.new_event_loop()
+		t = Thread(target=self.loop.run_forever)
+		t.daemon = True
+		t.start()
+	# returns a Future that resolves when `item` was sent
+	def submit(self, item):
+		try:
+			# created here because it might make blocking calls (get_chat)
+			coro = item.payload.request(self.bot, item)
+		except telebot.apihelper.ApiException as e:
+			return check_telegram_exc(e, item.user_id, item.payload.leave)
+		self.slots.acquire()
+		fut = asyncio.run_coroutine_threadsafe(item.call_async(coro), self.loop)
+		fut.add_done_callback(lambda _: self.slots.release())
+		return fut
+
+###
+
 # Message sending (queue-related)
 
+# Payloads describe what is being delivered and are shared by all queue items
+# of a message, the items themselves only hold what differs per recipient.
+
+class SendPayload():
+	__slots__ = ("ev", "force_caption", "leave")
+	def __init__(self, ev, force_caption=None, leave=True):
+		self.ev = ev # message to send (multiple types possible)
+		self.force_caption = force_caption
+		self.leave = leave # force-leave user if the bot was blocked?
+	# makes the API call using the passed bot
+	def request(self, api, item):
+		return send_to_single_inner(item.user_id, self.ev, item.arg, self.force_caption, api=api)
+	# called with the result of the API call
+	def finish(self, item, ev2):
+		if item.msid is not None:
+			ch.saveMapping(item.user_id, item.msid, ev2.message_id)
+
+class DeletePayload():
+	__slots__ = ()
+	leave = False
+	def request(self, api, item):
+		return delete_message_inner(item.user_id, item.arg, api)
+	def finish(self, item, ret):
+		pass
+
+DELETE_PAYLOAD = DeletePayload()
+
 class QueueItem():
-	__slots__ = ("user_id", "msid", "func")
-	def __init__(self, user, msid, func):
-		self.user_id = None # who this item is being delivered to
-		if user is not None:
-			self.user_id = user.id
+	__slots__ = ("user_id", "msid", "payload", "arg")
+	def __init__(self, user_id, msid, payload, arg=None):
+		self.user_id = user_id # who this item is being delivered to
 		self.msid = msid # message id connected to this item
-		self.func = func
+		self.payload = payload
+		self.arg = arg # message id to reply to or to delete
+	# returns the number of seconds after which to retry, if applicable
 	def call(self):
 		try:
-			self.func()
+			ret = self.payload.request(bot, self)
+		except telebot.apihelper.ApiException as e:
+			return check_telegram_exc(e, self.user_id, self.payload.leave)
+		except Exception as e:
+			logging.exception("Exception raised during queued message")
+			return
+		self.payload.finish(self, ret)
+	async def call_async(self, coro):
+		try:
+			ret = await coro
+		except async_sender.ApiException as e:
+			# this can write to the db, which must not block the event loop
+			loop = asyncio.get_running_loop()
+			return await loop.run_in_executor(None, check_telegram_exc,
+				e, self.user_id, self.payload.leave)
 		except Exception as e:
 			logging.exception("Exception raised during queued message")
+			return
+		self.payload.finish(self, ret)
 
 def get_priority_for(user):
 	if user is None:
@@ -361,13 +549,22 @@ def get_priority_for(user):
 		return max(RANKS.values()) << 16
 	return user.getMessagePriority()
 
-def put_into_queue(user, msid, f):
-	message_queue.put(get_priority_for(user), QueueItem(user, msid, f))
+# items for the same chat are delivered in order and never concurrently
+def put_into_queue(user, msid, payload, arg=None, *, chat_id=None):
+	if chat_id is None:
+		chat_id = user.id
+	message_queue.put(get_priority_for(user), chat_id, QueueItem(chat_id, msid, payload, arg))
 
-def send_thread():
-	while True:
-		item = message_queue.get()
-		item.call()
+def send_item(chat_id, item):
+	wait = rate_limiter.acquire(chat_id)
+	if wait > 0:
+		return wait # chat is over its budget, try again later
+	if async_sender is not None:
+		return async_sender.submit(item)
+	return item.call()
+
+def start_send_threads():
+	send_pool.start()
 
 ###
 
@@ -385,20 +582,22 @@ def should_hide_forward(ev):
 		return ev.forward_from.username in HIDE_FORWARD_FROM
 	return False
 
-def resend_message(chat_id, ev, reply_to=None, force_caption: FormattedMessage=None):
+def resend_message(chat_id, ev, reply_to=None, force_caption: FormattedMessage=None, api=None):
+	if api is None:
+		api = bot
 	# Check if the message is either voice or video
 	if ev.content_type in ("video_note", "voice"):
 		# We need the full Chat object here, because some properties are not available in the ev.chat trait
 		tchat = bot.get_chat(chat_id)
 		# Check if the user has disabled them
 		if tchat.has_restricted_voice_and_video_messages:
-			return bot.send_message(chat_id, rp.formatForTelegram(rp.Reply(rp.types.ERR_VOICE_AND_VIDEO_PRIVACY_RESTRICTION)), parse_mode="HTML")
+			return api.send_message(chat_id, rp.formatForTelegram(rp.Reply(rp.types.ERR_VOICE_AND_VIDEO_PRIVACY_RESTRICTION)), parse_mode="HTML")
 
 	if should_hide_forward(ev):
 		pass
 	elif is_forward(ev) and (ev.content_type != "poll"):
 		# forward message instead of re-sending the contents
-		return bot.forward_message(chat_id, ev.chat.id, ev.message_id)
+		return api.forward_message(chat_id, ev.chat.id, ev.message_id)
 
 	kwargs = {}
 	if reply_to is not None:
@@ -414,55 +613,57 @@ def resend_message(chat_id, ev, reply_to=None, force_caption: FormattedMessage=N
 
 	# re-send message based on content type
 	if ev.content_type == "text":
-		return bot.send_message(chat_id, ev.text, **kwargs)
+		return api.send_message(chat_id, ev.text, **kwargs)
 	elif ev.content_type == "photo":
 		photo = sorted(ev.photo, key=lambda e: e.width*e.height, reverse=True)[0]
-		return bot.send_photo(chat_id, photo.file_id, **kwargs)
+		return api.send_photo(chat_id, photo.file_id, **kwargs)
 	elif ev.content_type == "audio":
 		for prop in ("performer", "title"):
 			kwargs[prop] = getattr(ev.audio, prop)
-		return bot.send_audio(chat_id, ev.audio.file_id, **kwargs)
+		return api.send_audio(chat_id, ev.audio.file_id, **kwargs)
 	elif ev.content_type == "animation":
-		return bot.send_animation(chat_id, ev.animation.file_id, **kwargs)
+		return api.send_animation(chat_id, ev.animation.file_id, **kwargs)
 	elif ev.content_type == "document":
-		return bot.send_document(chat_id, ev.document.file_id, **kwargs)
+		return api.send_document(chat_id, ev.document.file_id, **kwargs)
 	elif ev.content_type == "video":
-		return bot.send_video(chat_id, ev.video.file_id, **kwargs)
+		return api.send_video(chat_id, ev.video.file_id, **kwargs)
 	elif ev.content_type == "voice":
-		return bot.send_voice(chat_id, ev.voice.file_id, **kwargs)
+		return api.send_voice(chat_id, ev.voice.file_id, **kwargs)
 	elif ev.content_type == "video_note":
-		return bot.send_video_note(chat_id, ev.video_note.file_id, **kwargs)
+		return api.send_video_note(chat_id, ev.video_note.file_id, **kwargs)
 	elif ev.content_type == "location":
 		kwargs["latitude"] = ev.location.latitude
 		kwargs["longitude"] = ev.location.longitude
-		return bot.send_location(chat_id, **kwargs)
+		return api.send_location(chat_id, **kwargs)
 	elif ev.content_type == "venue":
 		kwargs["latitude"] = ev.venue.location.latitude
 		kwargs["longitude"] = ev.venue.location.longitude
 		for prop in VENUE_PROPS:
 			kwargs[prop] = getattr(ev.venue, prop)
-		return bot.send_venue(chat_id, **kwargs)
+		return api.send_venue(chat_id, **kwargs)
 	elif ev.content_type == "contact":
 		for prop in ("phone_number", "first_name", "last_name"):
 			kwargs[prop] = getattr(ev.contact, prop)
-		return bot.send_contact(chat_id, **kwargs)
+		return api.send_contact(chat_id, **kwargs)
 	elif ev.content_type == "sticker":
-		return bot.send_sticker(chat_id, ev.sticker.file_id, **kwargs)
+		return api.send_sticker(chat_id, ev.sticker.file_id, **kwargs)
 	elif ev.content_type == "poll":
-		return bot.forward_message(chat_id, ev.chat.id, ev.message_id)
+		return api.forward_message(chat_id, ev.chat.id, ev.message_id)
 	else:
 		raise NotImplementedError("content_type = %s" % ev.content_type)
 
 # send a message `ev` (multiple types possible) to Telegram ID `chat_id`
-# returns the sent Telegram message
-def send_to_single_inner(chat_id, ev, reply_to=None, force_caption=None):
+# returns the sent Telegram message (or a coroutine if `api` is asynchronous)
+def send_to_single_inner(chat_id, ev, reply_to=None, force_caption=None, api=None):
+	if api is None:
+		api = bot
 	if isinstance(ev, rp.Reply):
 		kwargs2 = {}
 		if reply_to is not None:
 			kwargs2["reply_to_message_id"] = reply_to
 			kwargs2["allow_sending_without_reply"] = True
 		kwargs2["disable_web_page_preview"] = True
-		return bot.send_message(chat_id, rp.formatForTelegram(ev), parse_mode="HTML", **kwargs2)
+		return api.send_message(chat_id, rp.formatForTelegram(ev), parse_mode="HTML", **kwargs2)
 	elif isinstance(ev, FormattedMessage):
 		kwargs2 = {}
 		if reply_to is not None:
@@ -470,12 +671,13 @@ def send_to_single_inner(chat_id, ev, reply_to=None, force_caption=None):
 			kwargs2["allow_sending_without_reply"] = True
 		if ev.html:
 			kwargs2["parse_mode"] = "HTML"
-		return bot.send_message(chat_id, ev.content, **kwargs2)
+		return api.send_message(chat_id, ev.content, **kwargs2)
 
-	return resend_message(chat_id, ev, reply_to=reply_to, force_caption=force_caption)
+	return resend_message(chat_id, ev, reply_to=reply_to, force_caption=force_caption, api=api)
 
 # queue sending of a single message `ev` (multiple types possible) to User `user`
 # this includes saving of the sent message id to the cache mapping.
+# `ev` can also be a SendPayload, which should be used when sending to many users
 # `reply_msid` can be a msid of the message that will be replied to
 # `force_caption` can be a FormattedMessage to set the caption for resent media
 def send_to_single(ev, msid, user, *, reply_msid=None, force_caption=None):
@@ -484,52 +686,36 @@ def send_to_single(ev, msid, user, *, reply_msid=None, force_caption=None):
 	if reply_msid is not None:
 		reply_to = ch.lookupMapping(user.id, msid=reply_msid)
 
-	user_id = user.id
-	def f():
-		while True:
-			try:
-				ev2 = send_to_single_inner(user_id, ev, reply_to, force_caption)
-			except telebot.apihelper.ApiException as e:
-				retry = check_telegram_exc(e, user_id)
-				if retry:
-					continue
-				return
-			break
-		ch.saveMapping(user_id, msid, ev2.message_id)
-	put_into_queue(user, msid, f)
+	payload = ev if isinstance(ev, SendPayload) else SendPayload(ev, force_caption)
+	put_into_queue(user, msid, payload, reply_to)
 
 # delete message with `id` in Telegram chat `user_id`
-def delete_message_inner(user_id, id):
-	while True:
-		try:
-			bot.delete_message(user_id, id)
-		except telebot.apihelper.ApiException as e:
-			retry = check_telegram_exc(e, None)
-			if retry:
-				continue
-			return
-		break
-
-# look at given Exception `e`, force-leave user if bot was blocked
-# returns True if message sending should be retried
-def check_telegram_exc(e, user_id):
+def delete_message_inner(user_id, id, api=None):
+	if api is None:
+		api = bot
+	return api.delete_message(user_id, id)
+
+# look at given Exception `e` for a message to `chat_id`,
+# force-leave user if bot was blocked (unless `leave` is False)
+# returns the number of seconds after which sending should be retried, if applicable
+def check_telegram_exc(e, chat_id, leave=True):
 	errmsgs = ["bot was blocked by the user", "user is deactivated",
 		"PEER_ID_INVALID", "bot can't initiate conversation"]
-	if any(msg in e.result.text for msg in errmsgs):
-		if user_id is not None:
-			core.force_user_leave(user_id)
-		return False
+	# works for exceptions from both the synchronous and the asyncio API
+	text = getattr(e, "description", None) or str(e)
+	if any(msg in text for msg in errmsgs):
+		if leave:
+			core.force_user_leave(chat_id)
+		return
 
-	if "Too Many Requests" in e.result.text:
-		d = json.loads(e.result.text)["parameters"]["retry_after"]
+	if "Too Many Requests" in text:
+		d = e.result_json["parameters"]["retry_after"]
 		d = min(d, 30) # supposedly this is in seconds, but you sometimes get 100 or even 2000
 		if d >= 20: # We do not need to log cooldowns of less than 20, this would flood the channel
-			logging.warning("API rate limit hit, waiting for %ds", d)
-		time.sleep(d)
-		return True # retry
+			logging.warning("API rate limit hit, pausing for %ds", d)
+		return rate_limiter.penalize(chat_id, d)
 
-	logging.exception("API exception")
-	return False
+	logging.error("API exception", exc_info=e) # not always called from the except block
 
 ####
 
@@ -544,59 +730,45 @@ class MyReceiver(core.Receiver):
 		if who is not None:
 			return send_to_single(m, msid, who, reply_msid=reply_msid)
 
-		for user in db.iterateUsers():
-			if not user.isJoined():
-				continue
-			if user == except_who and not user.debugEnabled:
+		rp.formatForTelegram(m) # format once here instead of in every send thread
+		payload = SendPayload(m)
+		for user in core.recipients.list():
+			if except_who is not None and user.id == except_who.id and not user.debugEnabled:
 				continue
-			send_to_single(m, msid, user, reply_msid=reply_msid)
+			send_to_single(payload, msid, user, reply_msid=reply_msid)
 	@staticmethod
 	def delete(msids):
 		msids_set = set(msids)
 		# first stop actively delivering this message
-		message_queue.delete(lambda item: item.msid in msids_set)
+		for msid in msids_set:
+			message_queue.deleteBy(msid)
 		# then delete all instances that have already been sent
-		msids_owner = []
-		for msid in msids:
-			tmp = ch.getMessage(msid)
-			msids_owner.append(None if tmp is None else tmp.user_id)
-		assert len(msids_owner) == len(msids)
 		# FIXME: there's a hard to avoid race condition here:
 		# if a message is currently being sent, but finishes after we grab the
 		# message ids it will never be deleted
-		for user in db.iterateUsers():
-			if not user.isJoined():
-				continue
-
-			for j, msid in enumerate(msids):
-				if user.id == msids_owner[j] and not user.debugEnabled:
-					continue
-				id = ch.lookupMapping(user.id, msid=msid)
-				if id is None:
+		for msid in msids:
+			tmp = ch.getMessage(msid)
+			owner = None if tmp is None else tmp.user_id
+			for user_id, id in ch.getMappings(msid).items():
+				user = core.recipients.get(user_id)
+				if user is None:
+					continue # not in chat anymore
+				if user_id == owner and not user.debugEnabled:
 					continue
-				user_id = user.id
-				def f(user_id=user_id, id=id):
-					delete_message_inner(user_id, id)
 				# msid=None here since this is a deletion, not a message being sent
-				put_into_queue(user, None, f)
+				put_into_queue(user, None, DELETE_PAYLOAD, id)
 		# drop the mappings for this message so the id doesn't end up used e.g. for replies
 		for msid in msids_set:
 			ch.deleteMappings(msid)
 	@staticmethod
 	def stop_invoked(user, delete_out):
 		# delete pending messages to be delivered *to* the user
-		message_queue.delete(lambda item, user_id=user.id: item.user_id == user_id)
+		message_queue.deleteKey(user.id)
 		if not delete_out:
 			return
 		# delete all pending messages written *by* the user too
-		def f(item):
-			if item.msid is None:
-				return False
-			cm = ch.getMessage(item.msid)
-			if cm is None:
-				return False
-			return cm.user_id == user.id
-		message_queue.delete(f)
+		for msid in ch.getMessages(user.id).keys():
+			message_queue.deleteBy(msid)
 
 ####
 
@@ -691,7 +863,8 @@ def cmd_karmainfo(ev):
 
 def cmd_botinfo(ev):
 	c_user = UserContainer(ev.from_user)
-	send_answer(ev, core.get_bot_info(c_user), True)
+	send_pool.sample()
+	send_answer(ev, core.get_bot_info(c_user, send_pool.getStats()), True)
 
 def cmd_version(ev):
 	send_answer(ev, rp.Reply(rp.types.PROGRAM_VERSION, version=VERSION, url_catlounge=URL_CATLOUNGE, url_secretlounge=URL_SECRETLOUNGE), True)
@@ -883,15 +1056,13 @@ def relay_inner(ev, *, caption_text=None, signed=False, tripcode=False, ksigned=
 
 	# relay message to all other users
 	logging.debug("relay(): msid=%d reply_msid=%r", msid, reply_msid)
-	for user2 in db.iterateUsers():
-		if not user2.isJoined():
-			continue
-		if user2 == user and not user.debugEnabled:
+	payload = SendPayload(ev_tosend, force_caption)
+	for user2 in core.recipients.list():
+		if user2.id == user.id and not user.debugEnabled:
 			ch.saveMapping(user2.id, msid, ev.message_id)
 			continue
 
-		send_to_single(ev_tosend, msid, user2,
-			reply_msid=reply_msid, force_caption=force_caption)
+		send_to_single(payload, msid, user2, reply_msid=reply_msid)
 
 @takesArgument()
 def cmd_sign(ev, arg):
@@ -2,9 +2,11 @@ import itertools
 import time
 import logging
 import os
+import heapq
+from collections import deque
+from concurrent.futures import Future
 from datetime import datetime
-from queue import PriorityQueue
-from threading import Lock
+from threading import Lock, Condition, Thread
 from datetime import timedelta
 
 class Scheduler():
@@ -34,31 +36,232 @@ class Scheduler():
 			if wait > 0:
 				time.sleep(wait)
 
-class MutablePriorityQueue():
-	def __init__(self):
-		self.queue = PriorityQueue() # contains (prio, iid)
-		self.items = {} # maps iid -> opaque
+class QueueEntry():
+	__slots__ = ("prio", "data", "deleted")
+	def __init__(self, prio, data):
+		self.prio = prio
+		self.data = data
+		self.deleted = False
+
+class KeyedPriorityQueue():
+	# Priority queue where every item belongs to a key (e.g. a chat).
+	# Items with the same key are handed out in the order they were put and
+	# only one item per key can be taken at a time, until done() is called.
+	# If `index` names an attribute of the items, deleteBy() removes all items
+	# with a given value of it in time proportional to the number of matches.
+	# Deleted items are left in place and skipped once they are reached.
+	def __init__(self, index=None):
+		self.heap = [] # contains (prio, seq, key) for keys that are ready
+		self.pending = {} # maps key -> deque of QueueEntry
+		self.busy = {} # maps key -> prio of the item that was taken
+		self.paused = {} # maps key -> monotonic time it's paused until
+		self.resume = [] # contains (time, key) for paused keys
+		self.index_attr = index
+		self.index = {} # maps attribute value -> set of QueueEntry
 		self.counter = itertools.count()
-		# protects `items` and `counter`, `queue` has its own lock
+		self.size = 0 # excludes deleted entries
+		self.lock = Lock()
+		self.cond = Condition(self.lock)
+	def __len__(self):
+		return self.size
+	def _schedule(self, key):
+		# the heap may contain stale entries, get() skips those
+		prio = self.pending[key][0].prio
+		heapq.heappush(self.heap, (prio, next(self.counter), key))
+		self.cond.notify()
+	def _add(self, key, e, left=False):
+		q = self.pending.get(key)
+		if q is None:
+			q = self.pending[key] = deque()
+		if left:
+			q.appendleft(e)
+		else:
+			q.append(e)
+		self.size += 1
+		if self.index_attr is not None:
+			v = getattr(e.data, self.index_attr)
+			if v is not None:
+				if v not in self.index.keys():
+					self.index[v] = set()
+				self.index[v].add(e)
+		return len(q) == 1
+	def _remove(self, e):
+		e.deleted = True
+		self.size -= 1
+		if self.index_attr is not None:
+			v = getattr(e.data, self.index_attr)
+			entries = self.index.get(v)
+			if entries is not None:
+				entries.discard(e)
+				if len(entries) == 0:
+					del self.index[v]
+	def ready(self):
+		with self.lock:
+			return len(self.heap)
+	def _wakeup(self, now):
+		while len(self.resume) > 0 and self.resume[0][0] <= now:
+			_, key = heapq.heappop(self.resume)
+			if self.paused.pop(key, None) is not None and key in self.pending:
+				self._schedule(key)
+	def get(self, timeout=None):
+		if timeout is not None:
+			deadline = time.monotonic() + timeout
+		with self.lock:
+			while True:
+				now = time.monotonic()
+				self._wakeup(now)
+				if len(self.heap) == 0:
+					wait = None if timeout is None else deadline - now
+					if wait is not None and wait <= 0:
+						return None
+					if len(self.resume) > 0:
+						t = self.resume[0][0] - now
+						wait = t if wait is None else min(wait, t)
+					self.cond.wait(wait)
+					continue
+				_, _, key = heapq.heappop(self.heap)
+				q = self.pending.get(key)
+				if q is None or key in self.busy or key in self.paused:
+					continue
+				e = q.popleft()
+				while e.deleted and len(q) > 0:
+					e = q.popleft()
+				if len(q) == 0:
+					del self.pending[key]
+				if e.deleted:
+					continue # there were only deleted items left
+				self._remove(e)
+				self.busy[key] = e.prio
+				return key, e.data
+	def put(self, prio, key, data):
+		with self.lock:
+			first = self._add(key, QueueEntry(prio, data))
+			if first and key not in self.busy and key not in self.paused:
+				self._schedule(key)
+	# `retry` puts the taken item back in front of the others for this key,
+	# which is then paused for `delay` seconds
+	def done(self, key, retry=None, delay=0):
+		with self.lock:
+			prio = self.busy.pop(key)
+			if retry is not None:
+				self._add(key, QueueEntry(prio, retry), True)
+			if key not in self.pending:
+				return
+			if delay > 0:
+				t = time.monotonic() + delay
+				self.paused[key] = t
+				heapq.heappush(self.resume, (t, key))
+				self.cond.notify() # waiters need to recalculate their timeout
+			else:
+				self._schedule(key)
+	# delete all items with `key`, returns the number of items deleted
+	def deleteKey(self, key):
+		with self.lock:
+			q = self.pending.pop(key, ())
+			n = 0
+			for e in q:
+				if not e.deleted:
+					self._remove(e)
+					n += 1
+			return n
+	# delete all items whose index attribute equals `value`, returns the number of items deleted
+	def deleteBy(self, value):
+		with self.lock:
+			entries = self.index.pop(value, ())
+			for e in entries:
+				e.deleted = True
+			self.size -= len(entries)
+			return len(entries)
+
+class WorkerPool():
+	# Calls `handler(key, data)` for the items of a KeyedPriorityQueue on a
+	# number of threads that grows while there is a backlog and shrinks when idle.
+	# The handler can return a number of seconds after which to retry the item,
+	# or a Future of that if the item is finished asynchronously.
+	def __init__(self, queue, handler, min_workers=1, max_workers=1, idle_timeout=30):
+		assert 0 < min_workers <= max_workers
+		self.queue = queue
+		self.handler = handler
+		self.min_workers = min_workers
+		self.max_workers = max_workers
+		self.idle_timeout = idle_timeout
+		self.workers = 0
+		self.busy = 0
+		self.inflight = 0
+		self.processed = 0
+		self.rate = 0.0 # items per second, updated by sample()
+		self.last_sample = (time.monotonic(), 0)
+		# protects all of the counters above
 		self.lock = Lock()
-	def get(self):
+	def start(self):
+		with self.lock:
+			for _ in range(self.min_workers):
+				self._spawn()
+	def _spawn(self):
+		self.workers += 1
+		t = Thread(target=self._run)
+		t.daemon = True
+		t.start()
+	def _run(self):
 		while True:
-			_, iid = self.queue.get()
+			item = self.queue.get(self.idle_timeout)
+			if item is None:
+				with self.lock:
+					if self.workers > self.min_workers:
+						self.workers -= 1
+						return
+				continue
+			key, data = item
+			with self.lock:
+				self.busy += 1
+				# more keys are waiting than we have idle workers for
+				if self.workers < self.max_workers and self.queue.ready() > self.workers - self.busy:
+					self._spawn()
+			delay = None
+			try:
+				delay = self.handler(key, data)
+			except Exception as e:
+				logging.exception("Exception raised in worker")
+			with self.lock:
+				self.busy -= 1
+				if isinstance(delay, Future):
+					self.inflight += 1
+			if isinstance(delay, Future):
+				delay.add_done_callback(lambda f, key=key, data=data: self._finish(key, data, f))
+			else:
+				self._finish(key, data, delay)
+	def _finish(self, key, data, delay):
+		if isinstance(delay, Future):
+			with self.lock:
+				self.inflight -= 1
+			if delay.exception() is not None:
+				logging.error("Exception raised in worker", exc_info=delay.exception())
+				delay = None
+			else:
+				delay = delay.result()
+		if delay:
+			self.queue.done(key, data, delay)
+		else:
+			self.queue.done(key)
 			with self.lock:
-				# skip deleted entries
-				if iid in self.items.keys():
-					return self.items.pop(iid)
-	def put(self, prio, data):
+				self.processed += 1
+	def sample(self):
 		with self.lock:
-			iid = next(self.counter)
-			self.items[iid] = data
-		self.queue.put((prio, iid))
-	def delete(self, selector):
+			now = time.monotonic()
+			t, n = self.last_sample
+			if now > t:
+				self.rate = (self.processed - n) / (now - t)
+			self.last_sample = (now, self.processed)
+	def getStats(self):
 		with self.lock:
-			keys = list(self.items.keys())
-			for iid in keys:
-				if selector(self.items[iid]):
-					del self.items[iid]
+			return {
+				"workers": self.workers,
+				"busy": self.busy,
+				"inflight": self.inflight,
+				"queued": len(self.queue),
+				"processed": self.processed,
+				"rate": self.rate,
+			}
 
 class Enum():
 	def __init__(self, m, reverse=True):
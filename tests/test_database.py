@@ -0,0 +1,106 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from src.database import User, JSONDatabase, SQLiteDatabase
+
+class KarmaTestMixin():
+	def setUp(self):
+		self.dir = tempfile.TemporaryDirectory()
+		self.db = self.open(os.path.join(self.dir.name, "db"))
+		for id in range(1, 4):
+			user = User()
+			user.defaults()
+			user.id = id
+			user.realname = "user%d" % id
+			self.db.addUser(user)
+	def tearDown(self):
+		self.db.close()
+		self.dir.cleanup()
+
+	def test_vote_update_flush(self):
+		self.db.addKarma(1, 1)
+		self.db.updateUser(1, lambda user: setattr(user, "debugEnabled", True))
+		self.assertEqual(self.db.getUser(id=1).karma, 1)
+		self.db.flushKarma()
+		self.assertEqual(self.db.getUser(id=1).karma, 1)
+		self.assertEqual(self.stored_karma(1), 1)
+
+	def test_vote_karma_update_flush(self):
+		self.db.addKarma(1, 2)
+		def f(user):
+			user.karma -= 5
+		self.db.updateUser(1, f)
+		self.assertEqual(self.db.addKarma(1, 1), -2)
+		self.db.flushKarma()
+		self.assertEqual(self.db.getUser(id=1).karma, -2)
+		self.assertEqual(self.stored_karma(1), -2)
+
+	def test_concurrent_votes_and_updates(self):
+		def vote():
+			for i in range(500):
+				self.db.addKarma(2, 1)
+		def update():
+			for i in range(100):
+				def f(user):
+					user.karma -= 1
+					user.debugEnabled = not user.debugEnabled
+				self.db.updateUser(2, f)
+		stop = threading.Event()
+		def flush():
+			while not stop.is_set():
+				self.db.flushKarma()
+		threads = [threading.Thread(target=vote) for i in range(3)]
+		threads.append(threading.Thread(target=update))
+		flusher = threading.Thread(target=flush)
+		flusher.start()
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		stop.set()
+		flusher.join()
+		self.db.flushKarma()
+		self.assertEqual(self.db.getUser(id=2).karma, 1400)
+		self.assertEqual(self.stored_karma(2), 1400)
+
+	def test_votes_survive_crash(self):
+		self.db.addKarma(1, 2)
+		self.db.addKarma(2, 1)
+		self.db.flushKarma()
+		self.db.addKarma(1, 3)
+		def f(user):
+			user.karma -= 10
+		self.db.updateUser(1, f)
+		self.db.addKarma(1, 1)
+		self.db.addKarma(3, -1)
+		# neither flushed nor closed, as if the process had died
+		self.db = self.open(self.path)
+		self.assertEqual(self.db.getUser(id=1).karma, -4)
+		self.assertEqual(self.db.getUser(id=2).karma, 1)
+		self.assertEqual(self.db.getUser(id=3).karma, -1)
+		self.db.flushKarma()
+		self.assertEqual(self.stored_karma(1), -4)
+
+class TestSQLiteKarma(KarmaTestMixin, unittest.TestCase):
+	def open(self, path):
+		self.path = path
+		return SQLiteDatabase(path)
+	def stored_karma(self, id):
+		conn = sqlite3.connect(self.path)
+		try:
+			return conn.execute("SELECT karma FROM users WHERE id = ?", (id, )).fetchone()[0]
+		finally:
+			conn.close()
+
+class TestJSONKarma(KarmaTestMixin, unittest.TestCase):
+	def open(self, path):
+		self.path = path
+		return JSONDatabase(path)
+	def stored_karma(self, id):
+		return self.db.users[id]["karma"]
+
+if __name__ == "__main__":
+	unittest.main()
@@ -3,6 +3,7 @@ import sys
 import os
 import logging
 import sqlite3
+import calendar
 import readline # for input()
 from datetime import datetime, timedelta
 from time import sleep
@@ -10,10 +11,16 @@ from time import sleep
 # database
 # NOTE: a few other utilities import these functions from here
 
+# timestamps are stored as epochs of the (local) time taken as UTC
+def to_epoch(dt):
+	return calendar.timegm(dt.timetuple())
+
+def from_epoch(t):
+	return None if t is None else datetime.utcfromtimestamp(t)
+
 class Database():
 	def __init__(self, path):
-		t = sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES
-		self.db = sqlite3.connect(path, detect_types=t)
+		self.db = sqlite3.connect(path)
 		self.db.row_factory = sqlite3.Row
 	def modify_custom(self, func):
 		while True:
@@ -89,7 +96,7 @@ def ban_user(db, id, reason):
 	row = c.fetchone()
 	if row is None:
 		# user was never here, add an placeholder entry to still ban them
-		nodate = datetime.utcfromtimestamp(0)
+		nodate = 0
 		u = {
 			"id": id,
 			"realname": "",
@@ -109,7 +116,7 @@ def ban_user(db, id, reason):
 	elif row[0] == -10:
 		return 0, 0 # user was already banned
 	# update user values to ban them
-	param = (-10, datetime.now(), reason, id)
+	param = (-10, to_epoch(datetime.now()), reason, id)
 	db.modify("UPDATE users SET rank = ?, left = ?, blacklistReason = ? WHERE id = ?", param)
 	return 1, 0
 
@@ -118,7 +125,7 @@ def unban_user(db, id):
 	row = c.fetchone()
 	if row is None:
 		return 0
-	if row[0] == datetime.utcfromtimestamp(0):
+	if row[0] == 0:
 		# this is a placeholder entry, just delete it instead
 		db.modify("DELETE FROM users WHERE id = ?", (id, ))
 	else:
@@ -134,7 +141,7 @@ def sync(d):
 		# find all blacklists that happened since our last update
 		l = []
 		for name, db in d.items():
-			c = db.execute("SELECT id, blacklistReason FROM users WHERE rank = ? AND left >= ?", (-10, last_update))
+			c = db.execute("SELECT id, blacklistReason FROM users WHERE rank = ? AND left >= ?", (-10, to_epoch(last_update)))
 			for row in c:
 				reason = row[1] or ""
 				if reason.endswith("]"): # transferred from elsewhere?
@@ -165,8 +172,9 @@ def find_user(db, term):
 		args += [int(term)]
 	c = db.execute(sql, args)
 	ret = {}
+	dates = ("joined", "left", "lastActive", "cooldownUntil", "warnExpiry")
 	for row in c:
-		ret[row[0]] = row[1:]
+		ret[row[0]] = tuple(from_epoch(v) if k in dates else v for k, v in zip(attrs, row[1:]))
 	return ret, attrs
 
 # frontend
@@ -5,7 +5,7 @@ import logging
 from datetime import datetime, timedelta
 from time import sleep
 
-from blacklist import detect_dbs, print_function_help
+from blacklist import detect_dbs, print_function_help, from_epoch
 
 # backend
 
@@ -15,7 +15,7 @@ def list_privileged_users(db, cond="rank > 0"):
 	ret = {}
 	for row in c:
 		user = ("@" + row[1]) if row[1] is not None else row[2]
-		active = None if row[4] is not None else row[5]
+		active = None if row[4] is not None else from_epoch(row[5])
 		ret[row[0]] = (user, row[3], active)
 	return ret
 